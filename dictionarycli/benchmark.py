@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# Compare the throughput of sanakirjacli's result page extraction against the
+# original full tree parse, on saved result pages or synthetic ones
+
+import argparse
+import os
+import sys
+import time
+import bs4 as bs
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import sanakirjacli  # noqa: E402
+
+
+# Original implementation, which built a tree of the whole page every time
+def _legacy_parse(page_content, synonymes=False, definitions=False):
+    soup = bs.BeautifulSoup(page_content, "html.parser")
+
+    elem_translations = soup.select(".content > table.translations tr[class^=sk] > td > a")
+    translations = [t.text.strip() for t in elem_translations]
+
+    result = {"translations": translations, "synonymes": None, "definitions": None}
+    if synonymes:
+        elem_synonymes = soup.select(".content > .lists > .synonyms > ul > li > a")
+        result["synonymes"] = [t.text.strip() for t in elem_synonymes]
+    if definitions:
+        elem_definitions = soup.select(".content > .definitions > ol > li")
+        result["definitions"] = [t.text.strip() for t in elem_definitions]
+    return result
+
+
+def _synthetic_page(word, count):
+    """Result page shaped like sanakirja.org's, with count translations"""
+    parts = ['<html><head><title>{}</title>'.format(word)]
+    parts += ['<script src="/js/{}.js"></script>'.format(i) for i in range(20)]
+    parts.append('</head><body><div id="header"><ul class="menu">')
+    parts += ['<li><a href="/page{0}">Page {0}</a></li>'.format(i) for i in range(60)]
+    parts.append('</ul></div><div class="content"><h1>{}</h1>'.format(word))
+    parts.append('<table class="translations"><tr><th>#</th><th>Translation</th></tr>')
+    for i in range(count):
+        parts.append('<tr class="sk-row{}"><td>{}</td><td><a href="/w/{}">{}-{}</a></td></tr>'.format(
+            i % 2 + 1, i, i, word, i))
+    parts.append('</table><div class="lists"><div class="synonyms"><h3>Synonyms</h3><ul>')
+    parts += ['<li><a href="/s/{0}">{1}-syn{0}</a></li>'.format(i, word) for i in range(10)]
+    parts.append('</ul></div></div><div class="definitions"><ol>')
+    parts += ['<li>{} means thing number {}</li>'.format(word, i) for i in range(5)]
+    parts.append('</ol></div></div><div id="footer">')
+    parts += ['<p>Related: <a href="/r/{0}">{0}</a> <span class="x">text</span></p>'.format(i)
+              for i in range(300)]
+    parts.append('</div></body></html>')
+    return "\n".join(parts).encode("utf-8")
+
+
+def _time(parse, pages, rounds, synonymes, definitions):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for page in pages:
+            parse(page, synonymes, definitions)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="sanakirjacli extraction benchmark")
+    parser.add_argument("pages", nargs="*", help="saved result pages, synthetic ones if none")
+    parser.add_argument("-n", "--rounds", type=int, default=5, help="times to parse every page")
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = []
+        for path in args.pages:
+            with open(path, "rb") as file:
+                pages.append(file.read())
+    else:
+        pages = [_synthetic_page("word{}".format(i), 5 + i % 20) for i in range(50)]
+
+    for page in pages:
+        for flags in ((False, False), (True, True)):
+            if _legacy_parse(page, *flags) != sanakirjacli.__parse(page, *flags):
+                print("Results differ from the original implementation", file=sys.stderr)
+                exit(1)
+
+    print("parser: {}, {} pages, {} rounds".format(sanakirjacli.__get_html()[1], len(pages), args.rounds))
+    print("{:>26} {:>12} {:>12} {:>8}".format("mode", "legacy p/s", "lazy p/s", "speedup"))
+    total = len(pages) * args.rounds
+    for name, flags in (("translations", (False, False)),
+                        ("synonymes and definitions", (True, True))):
+        legacy = _time(_legacy_parse, pages, args.rounds, *flags)
+        lazy = _time(sanakirjacli.__parse, pages, args.rounds, *flags)
+        print("{:>26} {:>12.0f} {:>12.0f} {:>7.1f}x".format(
+            name, total / legacy, total / lazy, legacy / lazy))
+
+
+if __name__ == "__main__":
+    main()
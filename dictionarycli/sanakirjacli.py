@@ -4,8 +4,12 @@
 HELP = """Terminal dictionary
 Uses Sanakirja.org as a source which in turn is based on Wiktionary
 
-Usage: 
+Usage:
 translator <from_language> <to_language> <word> <options>
+translator <from_language> <to_language>,<to_language>... <word> <options>
+translator <from_language> all <word> <options>
+translator <from_language> <to_language> -b <file> <options>
+translator <from_language> <to_language> -X
 
 Options:
 -l --list           List available languages
@@ -15,13 +19,36 @@ Options:
 -n --limit          Limit the number of translations retrieved
 -h --help           Display this info
 -r --raw            Only print the translations, nothing else
+-b --batch          Translate every word in a file, one per line, - for stdin
+-j --jobs           Number of concurrent lookups in batch mode (default 8)
+-t --timeout        Request timeout in seconds (default 10)
+-R --retries        Times to retry a failed request (default 2)
+-C --no-cache       Fetch fresh results instead of using the local cache
+-P --purge-cache    Empty the local cache
+-X --export         Export cached results of the language pair to the offline index
+-O --offline        Only consult the offline index, never the network
+-p --prefix         With --offline, list every indexed word starting with the word
+-J --json           Print the results as JSON
+-D --daemon         Serve lookups over a local socket, used automatically when running
 """
 
 
+import json
+import mmap
+import os
+import re
+import signal
+import socket
+import sqlite3
+import struct
 import sys
-import bs4 as bs
-from urllib.request import urlopen
-from urllib.parse import quote_plus
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from urllib.parse import quote_plus, urljoin, urlsplit
 
 # Languages and their abbreviations
 LANGUAGES = {
@@ -54,6 +81,57 @@ LANGUAGES = {
 # Query URL
 URL = "http://www.sanakirja.org/search.php?q=@Word&l=@Lang1&l2=@Lang2"
 
+# Defaults for the HTTP connections
+DEFAULT_JOBS = 8
+DEFAULT_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+MAX_REDIRECTS = 5
+# Seconds a pooled connection may stay idle, servers close idle keep-alive
+# connections after a few seconds
+POOL_IDLE_TIMEOUT = 2
+
+# Local cache of lookup results
+CACHE_FILE = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                          "sanakirjacli", "cache.sqlite")
+CACHE_TTL = 30 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 50000
+
+# Offline index of exported results, one file per language pair
+INDEX_DIR = os.path.join(os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share")),
+                         "sanakirjacli")
+INDEX_MAGIC = b"SKIX"
+INDEX_VERSION = 1
+# Magic, version and entry count, followed by count + 1 entry offsets
+INDEX_HEADER = struct.Struct("<4sHI")
+INDEX_OFFSET = struct.Struct("<I")
+# Separators of the parts of an entry and the words of a part
+INDEX_PART_SEP = "\x1f"
+INDEX_WORD_SEP = "\x1e"
+
+# Start of the translations table and the end of a table on a result page
+TRANSLATIONS_START = re.compile(rb"""<table\b[^>]*\bclass\s*=\s*["']?[^"'>]*\btranslations\b""", re.IGNORECASE)
+TABLE_END = re.compile(rb"</table\s*>", re.IGNORECASE)
+
+# Socket of the lookup daemon
+DAEMON_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir()),
+                             "sanakirjacli-{}.sock".format(os.getuid()))
+
+# Idle keep-alive connections and when they went idle by scheme and host, shared by
+# every thread so the daemon's client threads reuse each other's connections
+__connections = {}
+__connections_lock = threading.Lock()
+
+# Cache database connection, shared by every thread and used under its lock
+__cache = None
+__cache_lock = threading.RLock()
+
+# Daemon connection of the current thread
+__daemon = threading.local()
+
+# bs4 and the name of the parser backend, imported on first parse so lookups answered by
+# the daemon or the offline index skip the imports
+__html = None
+
 
 # Return argument position or -1 if not found
 def __get_argument_pos(arguments, short, long):
@@ -62,8 +140,9 @@ def __get_argument_pos(arguments, short, long):
         if not argument.startswith("-"):
             continue
         if argument.startswith("--"):
-            argument = argument[2:]
-            return True if long == argument else -1
+            if long == argument[2:]:
+                return ind
+            continue
         argument = argument[1:]
         if (short in list(argument)):
             return ind
@@ -73,11 +152,518 @@ def __get_argument_pos(arguments, short, long):
 def __get_argument(arguments, short, long):
     return __get_argument_pos(arguments, short, long) >= 0
 
+# Return the value following an argument or default if not present
+def __get_argument_value(arguments, short, long, default=None):
+    pos = __get_argument_pos(arguments, short, long)
+    if pos < 0:
+        return default
+    if pos + 1 >= len(arguments):
+        __pexit("Value for --{} is missing".format(long))
+    return arguments[pos + 1]
+
+# Return the (long name, index) of a short or long language name or None if unknown
+def __find_language(name):
+    if name in LANGUAGES:
+        return LANGUAGES[name]
+    for long_name, index in LANGUAGES.values():
+        if long_name == name:
+            return long_name, index
+    return None
+
 # Print error and exit
 def __pexit(msg):
     print(str(msg))
     exit()
 
+# Print to stderr
+def __eprint(*args, **kwargs):
+    print(*args, file=sys.stderr, **kwargs)
+
+
+# Take an idle connection for the scheme and host from the pool or open a new one,
+# returns the connection and whether it was reused. Connections idle for longer
+# than POOL_IDLE_TIMEOUT are closed instead of reused
+def __get_connection(scheme, host, timeout, fresh=False):
+    expired = []
+    connection = None
+    with __connections_lock:
+        idle = __connections.get((scheme, host), [])
+        now = time.monotonic()
+        # Oldest first, so the expired ones are at the start
+        while idle and now - idle[0][1] > POOL_IDLE_TIMEOUT:
+            expired.append(idle.pop(0)[0])
+        if idle and not fresh:
+            connection = idle.pop()[0]
+    for stale in expired:
+        stale.close()
+    if connection is not None:
+        connection.timeout = timeout
+        return connection, True
+    connection_class = HTTPSConnection if scheme == "https" else HTTPConnection
+    return connection_class(host, timeout=timeout), False
+
+# Return a connection to the pool once its response has been read
+def __put_connection(scheme, host, connection):
+    with __connections_lock:
+        __connections.setdefault((scheme, host), []).append((connection, time.monotonic()))
+
+# GET a page over a keep-alive connection, following redirects
+def __http_get(url, timeout, retries):
+    for _ in range(MAX_REDIRECTS):
+        parts = urlsplit(url)
+        target = parts.path + ("?" + parts.query if parts.query else "")
+        attempt = 0
+        fresh = False
+        while True:
+            connection, reused = __get_connection(parts.scheme, parts.netloc, timeout, fresh)
+            response = None
+            try:
+                connection.request("GET", target)
+                response = connection.getresponse()
+                # Read the whole body so the connection can be reused
+                body = response.read()
+                __put_connection(parts.scheme, parts.netloc, connection)
+                break
+            except (HTTPException, OSError) as e:
+                connection.close()
+                if reused and response is None and isinstance(e, ConnectionError):
+                    # Closed by the server while pooled, not a failed attempt
+                    fresh = True
+                    continue
+                if attempt == retries:
+                    raise IOError(e) from e
+                time.sleep(0.5 * 2 ** attempt)
+                attempt += 1
+                fresh = False
+        if response.status in (301, 302, 303, 307, 308):
+            url = urljoin(url, response.getheader("Location"))
+            continue
+        if response.status != 200:
+            raise IOError("HTTP status {}".format(response.status))
+        return body
+    raise IOError("Too many redirects")
+
+# Fetch the result page for a word
+def __fetch(word, from_index, to_index, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES):
+    request_url = URL.replace("@Lang1", str(from_index)).replace("@Lang2", str(to_index)).replace("@Word", quote_plus(word))
+    return __http_get(request_url, timeout, retries)
+
+# Return bs4 and the parser backend to use, lxml when installed as it is several times faster
+def __get_html():
+    global __html
+    if __html is None:
+        import bs4
+        try:
+            import lxml  # noqa: F401
+            __html = (bs4, "lxml")
+        except ImportError:
+            __html = (bs4, "html.parser")
+    return __html
+
+# Extract translations, and synonymes and definitions if asked, from a result page.
+# Parts that were not asked for are None.
+# Only the sections asked for are built into a tree. Everything before the translations
+# table is skipped, and when only translations are needed so is everything after it
+def __parse(page_content, synonymes=False, definitions=False):
+    start = TRANSLATIONS_START.search(page_content)
+    if start is not None:
+        page_content = page_content[start.start():]
+    if not (synonymes or definitions):
+        if start is None:
+            return {"translations": [], "synonymes": None, "definitions": None}
+        end = TABLE_END.search(page_content)
+        if end is not None:
+            page_content = page_content[:end.end()]
+
+    classes = ["translations"]
+    if synonymes:
+        classes.append("synonyms")
+    if definitions:
+        classes.append("definitions")
+    bs, parser = __get_html()
+    strainer = bs.SoupStrainer(attrs={"class": classes})
+    soup = bs.BeautifulSoup(page_content, parser, parse_only=strainer)
+
+    elem_translations = soup.select("table.translations tr[class^=sk] > td > a")
+    translations = [t.text.strip() for t in elem_translations]
+
+    result = {"translations": translations, "synonymes": None, "definitions": None}
+    if synonymes:
+        elem_synonymes = soup.select(".synonyms > ul > li > a")
+        result["synonymes"] = [t.text.strip() for t in elem_synonymes]
+    if definitions:
+        elem_definitions = soup.select(".definitions > ol > li")
+        result["definitions"] = [t.text.strip() for t in elem_definitions]
+    return result
+
+# Return the connection to the cache database, only to be used holding __cache_lock
+def __get_cache():
+    global __cache
+    connection = __cache
+    if connection is None:
+        os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+        connection = __cache = sqlite3.connect(CACHE_FILE, timeout=10, check_same_thread=False)
+        connection.execute("""CREATE TABLE IF NOT EXISTS results (
+            word TEXT, from_lang INTEGER, to_lang INTEGER,
+            translations TEXT, synonymes TEXT, definitions TEXT,
+            fetched REAL, used REAL,
+            PRIMARY KEY (word, from_lang, to_lang))""")
+        connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+    return connection
+
+# Return a cached result if it has not expired and has the parts asked for
+def __cache_get(word, from_index, to_index, synonymes, definitions):
+    try:
+        with __cache_lock:
+            connection = __get_cache()
+            row = connection.execute(
+                "SELECT translations, synonymes, definitions FROM results "
+                "WHERE word = ? AND from_lang = ? AND to_lang = ? AND fetched > ?",
+                (word, from_index, to_index, time.time() - CACHE_TTL)).fetchone()
+            if row is None or (synonymes and row[1] is None) or (definitions and row[2] is None):
+                return None
+            with connection:
+                connection.execute(
+                    "UPDATE results SET used = ? WHERE word = ? AND from_lang = ? AND to_lang = ?",
+                    (time.time(), word, from_index, to_index))
+    except sqlite3.Error as e:
+        __eprint("Cache read failed: {}".format(e))
+        return None
+    return {
+        "translations": json.loads(row[0]),
+        "synonymes": None if row[1] is None else json.loads(row[1]),
+        "definitions": None if row[2] is None else json.loads(row[2]),
+    }
+
+# Store a freshly parsed result
+def __cache_put(word, from_index, to_index, result):
+    encoded = [None if result[k] is None else json.dumps(result[k])
+               for k in ("translations", "synonymes", "definitions")]
+    now = time.time()
+    try:
+        with __cache_lock, __get_cache() as connection:
+            connection.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               [word, from_index, to_index] + encoded + [now, now])
+    except sqlite3.Error as e:
+        __eprint("Cache write failed: {}".format(e))
+
+# Drop expired results and the least recently used ones over the size limit
+def __cache_evict():
+    try:
+        with __cache_lock, __get_cache() as connection:
+            connection.execute("DELETE FROM results WHERE fetched <= ?", (time.time() - CACHE_TTL,))
+            connection.execute(
+                "DELETE FROM results WHERE rowid IN "
+                "(SELECT rowid FROM results ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (CACHE_MAX_ENTRIES,))
+    except sqlite3.Error as e:
+        __eprint("Cache eviction failed: {}".format(e))
+
+# Empty the cache
+def __cache_purge():
+    with __cache_lock:
+        with __get_cache() as connection:
+            connection.execute("DELETE FROM results")
+        connection.execute("VACUUM")
+
+# Return every cached result of a language pair as (word, result), ignoring age.
+# Parts the result was fetched without are None
+def __cache_dump(from_index, to_index):
+    with __cache_lock:
+        rows = __get_cache().execute(
+            "SELECT word, translations, synonymes, definitions FROM results "
+            "WHERE from_lang = ? AND to_lang = ?", (from_index, to_index)).fetchall()
+    for word, translations, synonymes, definitions in rows:
+        yield word, {
+            "translations": json.loads(translations),
+            "synonymes": None if synonymes is None else json.loads(synonymes),
+            "definitions": None if definitions is None else json.loads(definitions),
+        }
+
+# Return the path of the offline index of a language pair
+def __index_path(from_index, to_index):
+    return os.path.join(INDEX_DIR, "{}-{}.idx".format(from_index, to_index))
+
+# Encode an index entry, the word and its result separated by a null byte
+def __index_encode(word, result):
+    parts = [INDEX_WORD_SEP.join(result[k]) for k in ("translations", "synonymes", "definitions")]
+    return word.encode("utf-8") + b"\0" + INDEX_PART_SEP.join(parts).encode("utf-8")
+
+# Decode the result part of an index entry
+def __index_decode(value):
+    parts = [p.split(INDEX_WORD_SEP) if p else [] for p in value.decode("utf-8").split(INDEX_PART_SEP)]
+    return {"translations": parts[0], "synonymes": parts[1], "definitions": parts[2]}
+
+# Write an index of (word, result) pairs. Entries are sorted by their UTF-8 bytes and
+# located through an offset table so lookups are a binary search over the mapped file
+def __index_write(path, results):
+    entries = sorted(__index_encode(word, result) for word, result in results.items())
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(entries)))
+        offset = 0
+        for entry in entries:
+            file.write(INDEX_OFFSET.pack(offset))
+            offset += len(entry)
+        file.write(INDEX_OFFSET.pack(offset))
+        for entry in entries:
+            file.write(entry)
+    os.replace(temp_path, path)
+    return len(entries)
+
+# Open an index, returns (map, entry count, offset table position, data position) or
+# None if there is no index for the pair
+def __index_open(path):
+    try:
+        with open(path, "rb") as file:
+            index_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    magic, version, count = INDEX_HEADER.unpack_from(index_map)
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        raise IOError("{} is not a supported index".format(path))
+    data_start = INDEX_HEADER.size + INDEX_OFFSET.size * (count + 1)
+    return index_map, count, INDEX_HEADER.size, data_start
+
+# Return the word and the start and end of its value in the mapped index for entry i
+def __index_entry(index, i):
+    index_map, _, table_start, data_start = index
+    start, end = struct.unpack_from("<II", index_map, table_start + INDEX_OFFSET.size * i)
+    start += data_start
+    end += data_start
+    separator = index_map.find(b"\0", start, end)
+    return index_map[start:separator], separator + 1, end
+
+# Return the position of the first entry not below key
+def __index_bisect(index, key):
+    low, high = 0, index[1]
+    while low < high:
+        middle = (low + high) // 2
+        if __index_entry(index, middle)[0] < key:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+# Return every (word, result) of an index
+def __index_items(index):
+    for i in range(index[1]):
+        word, start, end = __index_entry(index, i)
+        yield word.decode("utf-8"), __index_decode(index[0][start:end])
+
+# Return the indexed result of a word or None
+def __index_find(index, word):
+    key = word.encode("utf-8")
+    i = __index_bisect(index, key)
+    if i < index[1]:
+        found, start, end = __index_entry(index, i)
+        if found == key:
+            return __index_decode(index[0][start:end])
+    return None
+
+# Return (word, result) for every indexed word starting with prefix, in sorted order
+def __index_prefix(index, prefix):
+    key = prefix.encode("utf-8")
+    for i in range(__index_bisect(index, key), index[1]):
+        found, start, end = __index_entry(index, i)
+        if not found.startswith(key):
+            break
+        yield found.decode("utf-8"), __index_decode(index[0][start:end])
+
+# Merge the cached results of a language pair into its index, returns the entry count
+def __index_export(from_index, to_index):
+    path = __index_path(from_index, to_index)
+    results = {}
+    index = __index_open(path)
+    if index is not None:
+        results.update(__index_items(index))
+        index[0].close()
+    for word, result in __cache_dump(from_index, to_index):
+        # Parts the cached result was fetched without keep what the index had
+        indexed = results.get(word)
+        for part in ("synonymes", "definitions"):
+            if result[part] is None:
+                result[part] = indexed[part] if indexed is not None else []
+        results[word] = result
+    return __index_write(path, results)
+
+# Trim an indexed result to what was asked for
+def __index_select(result, limit, synonymes, definitions):
+    if limit is not None:
+        result["translations"] = result["translations"][0:limit]
+    if not synonymes:
+        result["synonymes"] = []
+    if not definitions:
+        result["definitions"] = []
+    return result
+
+# Look up a word, returns the parsed result. The cache is used unless cache is False,
+# fresh results are always stored
+def __lookup(word, from_index, to_index, limit=None, synonymes=False, definitions=False,
+             timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cache=True):
+    result = __cache_get(word, from_index, to_index, synonymes, definitions) if cache else None
+    if result is None:
+        page_content = __fetch(word, from_index, to_index, timeout, retries)
+        result = __parse(page_content, synonymes, definitions)
+        __cache_put(word, from_index, to_index, result)
+
+    if limit is not None:
+        result["translations"] = result["translations"][0:limit]
+    # Leave out the parts that were not asked for
+    if not synonymes or result["synonymes"] is None:
+        result["synonymes"] = []
+    if not definitions or result["definitions"] is None:
+        result["definitions"] = []
+    return result
+
+# Look up a word through the daemon, returns None if no daemon is running
+def __daemon_lookup(word, from_index, to_index, limit=None, synonymes=False, definitions=False,
+                    timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES, cache=True):
+    request = json.dumps({"word": word, "from": from_index, "to": to_index, "limit": limit,
+                          "synonymes": synonymes, "definitions": definitions,
+                          "timeout": timeout, "retries": retries, "cache": cache})
+    connection = getattr(__daemon, "connection", None)
+    try:
+        if connection is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.settimeout(1)
+                sock.connect(DAEMON_SOCKET)
+            except OSError:
+                sock.close()
+                return None
+            # Allow for every retry and redirect of the lookup on the daemon's side
+            sock.settimeout(timeout * (retries + 1) * MAX_REDIRECTS + 5)
+            connection = __daemon.connection = sock.makefile("rwb")
+            sock.close()
+        connection.write(request.encode("utf-8") + b"\n")
+        connection.flush()
+        response = connection.readline()
+        if not response:
+            raise OSError("Daemon closed the connection")
+    except OSError:
+        # The daemon went away, look up locally from now on
+        __daemon.connection = None
+        return None
+    response = json.loads(response)
+    if "error" in response:
+        raise IOError(response["error"])
+    return response["result"]
+
+# Answer lookup requests from a daemon client, one JSON object per line
+def __serve_client(connection):
+    with connection, connection.makefile("rwb") as file:
+        for line in file:
+            try:
+                request = json.loads(line)
+                result = __lookup(str(request["word"]), int(request["from"]), int(request["to"]),
+                                  request.get("limit"), bool(request.get("synonymes")),
+                                  bool(request.get("definitions")),
+                                  float(request.get("timeout", DEFAULT_TIMEOUT)),
+                                  int(request.get("retries", DEFAULT_RETRIES)),
+                                  bool(request.get("cache", True)))
+                response = {"result": result}
+            except IOError as e:
+                response = {"error": str(e)}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {"error": "Invalid request: {}".format(e)}
+            file.write(json.dumps(response).encode("utf-8") + b"\n")
+            file.flush()
+
+# Serve lookups on the daemon socket until interrupted, keeping the parser, the HTTP
+# connections and the cache warm between requests
+def __serve(path):
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            __pexit("A daemon is already listening on {}".format(path))
+        except OSError:
+            # Left behind by a daemon that did not shut down cleanly
+            os.remove(path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    # Remove the socket when stopped with SIGTERM as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit())
+    __get_html()
+    __cache_evict()
+    print("Listening on {}".format(path))
+    sys.stdout.flush()
+
+    last_evict = time.monotonic()
+    try:
+        while True:
+            connection, _ = server.accept()
+            threading.Thread(target=__serve_client, args=(connection,), daemon=True).start()
+            if time.monotonic() - last_evict > 60 * 60:
+                __cache_evict()
+                last_evict = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+
+# Map function over items with a thread pool, yielding results in input order as soon as
+# they are ready. Only a window of items is in flight so input can be streamed
+def __ordered_map(function, items, jobs):
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(function, item)))
+            if len(pending) >= jobs * 2:
+                yield pending[0][0], pending.popleft()[1]
+        while pending:
+            yield pending[0][0], pending.popleft()[1]
+
+# Print a list of words in the short or long format
+def __print_list(title, words, verbose):
+    if title is not None:
+        print(title)
+    if verbose:
+        for i, w in enumerate(words):
+            print("{}:\t{}".format(i, w))
+    else:
+        print(", ".join(words))
+
+# Print a lookup result
+def __print_result(result, verbose, raw):
+    __print_list(None if raw else "Translations:", result["translations"], verbose)
+    if raw:
+        return
+
+    # Print synonymes if needed
+    if len(result["synonymes"]) > 0:
+        print()
+        __print_list("Synonymes:", result["synonymes"], verbose)
+
+    # Print definitions if needed
+    definitions = result["definitions"]
+    if len(definitions) > 0:
+        print("\nDefinitions:")
+        if verbose:
+            for i, d in enumerate(definitions):
+                print("{}:\t{}".format(i, d))
+        else:
+            for d in definitions:
+                print(d)
+
+# Read words for batch mode, one per line
+def __read_words(file):
+    for line in file:
+        word = line.strip()
+        if len(word) > 0:
+            yield word
+
 
 # Application entry point
 if __name__ == "__main__":
@@ -91,16 +677,40 @@ if __name__ == "__main__":
     PARAM_LANGUAGES =   __get_argument(args, "l", "list")
     PARAM_HELP =        __get_argument(args, "h", "help")
     PARAM_RAW =         __get_argument(args, "r", "raw")
+    PARAM_BATCH =       __get_argument_value(args, "b", "batch")
+    PARAM_NO_CACHE =    __get_argument(args, "C", "no-cache")
+    PARAM_PURGE_CACHE = __get_argument(args, "P", "purge-cache")
+    PARAM_EXPORT =      __get_argument(args, "X", "export")
+    PARAM_OFFLINE =     __get_argument(args, "O", "offline")
+    PARAM_PREFIX =      __get_argument(args, "p", "prefix")
+    PARAM_JSON =        __get_argument(args, "J", "json")
+    PARAM_DAEMON =      __get_argument(args, "D", "daemon")
 
+    PARAM_LIMIT_NUMBER = None
     if PARAM_LIMIT:
         try:
             PARAM_LIMIT_NUMBER = int(args[__get_argument_pos(args, "n", "limit") + 1])
         except Exception:
             __pexit("Limit is missing")
 
+    try:
+        PARAM_JOBS = int(__get_argument_value(args, "j", "jobs", DEFAULT_JOBS))
+        PARAM_TIMEOUT = float(__get_argument_value(args, "t", "timeout", DEFAULT_TIMEOUT))
+        PARAM_RETRIES = int(__get_argument_value(args, "R", "retries", DEFAULT_RETRIES))
+    except ValueError:
+        __pexit("Invalid number for jobs, timeout or retries")
+
     if (PARAM_HELP or len(args) == 0):
         __pexit(HELP)
 
+    if PARAM_PURGE_CACHE:
+        __cache_purge()
+        print("Cache purged")
+
+    if PARAM_DAEMON:
+        __serve(DAEMON_SOCKET)
+        exit()
+
     if PARAM_LANGUAGES:
         print("Available languages:")
         print("Short\tLong\n")
@@ -108,86 +718,190 @@ if __name__ == "__main__":
             print("{}\t{}".format(k, v))
         exit()
 
-    # Extract non-flag arguments
-    __args = [a for a in args if not a.startswith("-")]
+    # Extract non-flag arguments, skipping the values of flags that take one
+    __values = set()
+    for short, long in (("n", "limit"), ("b", "batch"), ("j", "jobs"), ("t", "timeout"), ("R", "retries")):
+        pos = __get_argument_pos(args, short, long)
+        if pos >= 0:
+            __values.add(pos + 1)
+    __args = [a for i, a in enumerate(args) if not a.startswith("-") and i not in __values]
 
-    if len(__args) < 3:
+    if len(__args) < (2 if PARAM_BATCH is not None or PARAM_EXPORT else 3):
+        if PARAM_PURGE_CACHE and len(__args) == 0:
+            exit()
         __pexit("Missing some required arguments")
 
     PARAM_FROM_LANG = __args[0]
     PARAM_TO_LANG   = __args[1]
-    PARAM_WORD      = __args[2]
-
-    if PARAM_FROM_LANG == PARAM_TO_LANG:
-        __pexit("Languages cannot be the same")
 
     # Validate languages
-    all_langs = list(LANGUAGES.keys()) + [first for first, second in list(LANGUAGES.values())]
-    if PARAM_FROM_LANG not in all_langs:
+    FROM_LANG = __find_language(PARAM_FROM_LANG)
+    if FROM_LANG is None:
         __pexit("FROM language is invalid")
-    if PARAM_TO_LANG not in all_langs:
-        __pexit("TO language is invalid")
+    FROM_LANG_NAME, FROM_LANG_INDEX = FROM_LANG
+
+    # Several target languages are looked up concurrently
+    if PARAM_TO_LANG == "all":
+        TO_LANGS = [lang for lang in LANGUAGES.values() if lang != FROM_LANG]
+    else:
+        TO_LANGS = []
+        for name in PARAM_TO_LANG.split(","):
+            lang = __find_language(name)
+            if lang is None:
+                __pexit("TO language `{}` is invalid".format(name))
+            if lang == FROM_LANG:
+                __pexit("Languages cannot be the same")
+            if lang not in TO_LANGS:
+                TO_LANGS.append(lang)
+    FAN_OUT = PARAM_TO_LANG == "all" or len(TO_LANGS) > 1
+    if FAN_OUT and (PARAM_BATCH is not None or PARAM_PREFIX):
+        __pexit("Batch and prefix modes take a single TO language")
+
+    TO_LANG_NAME, TO_LANG_INDEX = TO_LANGS[0]
 
-    FROM_LANG_INDEX = LANGUAGES[PARAM_FROM_LANG][1]
-    TO_LANG_INDEX   = LANGUAGES[PARAM_TO_LANG][1]
-    FROM_LANG_NAME  = LANGUAGES[PARAM_FROM_LANG][0]
-    TO_LANG_NAME    = LANGUAGES[PARAM_TO_LANG][0]
+    # Build or update the offline indexes from the cache
+    if PARAM_EXPORT:
+        for to_name, to_index in TO_LANGS:
+            try:
+                count = __index_export(FROM_LANG_INDEX, to_index)
+            except (sqlite3.Error, IOError) as e:
+                __pexit("Export failed: {}".format(e))
+            print("Exported {} words from `{}` to `{}` into {}".format(
+                count, FROM_LANG_NAME, to_name, __index_path(FROM_LANG_INDEX, to_index)))
+        exit()
+
+    # Offline indexes by target language
+    __indexes = {}
+    if PARAM_OFFLINE:
+        for to_name, to_index in TO_LANGS:
+            try:
+                __indexes[to_index] = __index_open(__index_path(FROM_LANG_INDEX, to_index))
+            except IOError as e:
+                __pexit(e)
+            if __indexes[to_index] is None and not FAN_OUT:
+                __pexit("No offline index from `{}` to `{}`, create one with --export".format(FROM_LANG_NAME, to_name))
+        __index = __indexes[TO_LANG_INDEX]
+
+    # Set once a lookup goes to the local cache, which then needs evicting. The daemon
+    # evicts its own
+    looked_up_locally = threading.Event()
+
+    def lookup(word, to_index=TO_LANG_INDEX):
+        if PARAM_OFFLINE:
+            if __indexes[to_index] is None:
+                raise IOError("No offline index")
+            result = __index_find(__indexes[to_index], word)
+            if result is None:
+                return {"translations": [], "synonymes": [], "definitions": []}
+            return __index_select(result, PARAM_LIMIT_NUMBER, PARAM_SYNONYMES, PARAM_DEFINITIONS)
+        options = (word, FROM_LANG_INDEX, to_index, PARAM_LIMIT_NUMBER, PARAM_SYNONYMES,
+                   PARAM_DEFINITIONS, PARAM_TIMEOUT, PARAM_RETRIES, not PARAM_NO_CACHE)
+        result = __daemon_lookup(*options)
+        if result is None:
+            looked_up_locally.set()
+            result = __lookup(*options)
+        return result
+
+    # Translate a list of words, printing them in input order
+    if PARAM_BATCH is not None:
+        words_file = sys.stdin if PARAM_BATCH == "-" else open(PARAM_BATCH)
+        failed = False
+        for word, future in __ordered_map(lookup, __read_words(words_file), PARAM_JOBS):
+            try:
+                result = future.result()
+            except IOError as e:
+                __eprint("Lookup of `{}` failed: {}".format(word, e))
+                failed = True
+                continue
+            if len(result["translations"]) == 0:
+                __eprint("No translations found for `{}` from `{}` to `{}`".format(word, FROM_LANG_NAME, TO_LANG_NAME))
+                continue
+            if PARAM_RAW:
+                print("{}\t{}".format(word, ", ".join(result["translations"])))
+            else:
+                print("{}\n{}".format(word, "=" * len(word)))
+                __print_result(result, PARAM_VERBOSE, PARAM_RAW)
+                print()
+            sys.stdout.flush()
+        if looked_up_locally.is_set():
+            __cache_evict()
+        exit(1 if failed else 0)
+
+    PARAM_WORD = __args[2]
 
     # Validate word
     if not len(PARAM_WORD) > 0:
         __pexit("Invalid word")
 
+    # List every indexed word with the prefix
+    if PARAM_OFFLINE and PARAM_PREFIX:
+        found = False
+        for word, result in __index_prefix(__index, PARAM_WORD):
+            result = __index_select(result, PARAM_LIMIT_NUMBER, PARAM_SYNONYMES, PARAM_DEFINITIONS)
+            if PARAM_RAW:
+                print("{}\t{}".format(word, ", ".join(result["translations"])))
+            else:
+                print("{}\n{}".format(word, "=" * len(word)))
+                __print_result(result, PARAM_VERBOSE, PARAM_RAW)
+                print()
+            found = True
+        if not found:
+            __pexit("No indexed words start with `{}`".format(PARAM_WORD))
+        exit()
+
+    # Translate the word to every target language at once, printing them in the given order
+    if FAN_OUT:
+        results = {}
+        errors = {}
+        lookups = __ordered_map(lambda lang: lookup(PARAM_WORD, lang[1]), TO_LANGS, PARAM_JOBS)
+        for (to_name, _), future in lookups:
+            try:
+                results[to_name] = future.result()
+            except IOError as e:
+                errors[to_name] = str(e)
+        if looked_up_locally.is_set():
+            __cache_evict()
+
+        if PARAM_JSON:
+            print(json.dumps({"word": PARAM_WORD, "from": FROM_LANG_NAME,
+                              "results": results, "errors": errors}, ensure_ascii=False, indent=2))
+            exit(1 if errors else 0)
+
+        for to_name, error in errors.items():
+            __eprint("Lookup to `{}` failed: {}".format(to_name, error))
+        width = max(len(to_name) for to_name, _ in TO_LANGS)
+        for to_name, result in results.items():
+            if len(result["translations"]) == 0:
+                continue
+            if PARAM_RAW:
+                print("{}\t{}".format(to_name, ", ".join(result["translations"])))
+            elif result["synonymes"] or result["definitions"] or PARAM_VERBOSE:
+                print("{}\n{}".format(to_name, "=" * len(to_name)))
+                __print_result(result, PARAM_VERBOSE, PARAM_RAW)
+                print()
+            else:
+                print("{:<{}}  {}".format(to_name, width, ", ".join(result["translations"])))
+        if not any(len(result["translations"]) > 0 for result in results.values()):
+            __eprint("No translations found for `{}` from `{}`".format(PARAM_WORD, FROM_LANG_NAME))
+        exit(1 if errors else 0)
+
     # Do HTTP query
-    __request_url = URL.replace("@Lang1", str(FROM_LANG_INDEX)).replace("@Lang2", str(TO_LANG_INDEX)).replace("@Word", quote_plus(PARAM_WORD))
     try:
-        __page_content = urlopen(__request_url)
+        result = lookup(PARAM_WORD)
     except IOError:
         __pexit("Timeout")
-    
-    # Create HTML soup
-    soup = bs.BeautifulSoup(__page_content, "html.parser")
-    
-    elem_translations = soup.select(".content > table.translations tr[class^=sk] > td > a")
-    if len(elem_translations) == 0:
+
+    if PARAM_JSON:
+        print(json.dumps({"word": PARAM_WORD, "from": FROM_LANG_NAME, "to": TO_LANG_NAME,
+                          "result": result}, ensure_ascii=False, indent=2))
+        if looked_up_locally.is_set():
+            __cache_evict()
+        exit()
+
+    if len(result["translations"]) == 0:
         __pexit("No translations found for `{}` from `{}` to `{}`".format(PARAM_WORD, FROM_LANG_NAME, TO_LANG_NAME))
-    
-    translations = [t.text.strip() for t in elem_translations]
-    if PARAM_LIMIT:
-        translations = translations[0:PARAM_LIMIT_NUMBER]
 
     # Print translations
-    if not PARAM_RAW:
-        print("Translations:")
-    if PARAM_VERBOSE:
-        for i, t in enumerate(translations):
-            print("{}:\t{}".format(i, t))
-    else:
-        print(", ".join(translations))
-
-    if PARAM_RAW:
-        exit()
-    
-    # Print synonymes if needed
-    if PARAM_SYNONYMES:
-        elem_synonymes = soup.select(".content > .lists > .synonyms > ul > li > a")
-        synonymes = [t.text.strip() for t in elem_synonymes]
-        if len(synonymes) > 0:
-            print("\nSynonymes:")
-            if PARAM_VERBOSE:
-                for i, s in enumerate(synonymes):
-                    print("{}:\t{}".format(i, s))
-            else:
-                print(", ".join(synonymes))
-    
-    # Print definitions if needed
-    if PARAM_DEFINITIONS:
-        elem_definitions = soup.select(".content > .definitions > ol > li")
-        definitions = [t.text.strip() for t in elem_definitions]
-        if len(definitions) > 0:
-            print("\nDefinitions:")
-            if PARAM_VERBOSE:
-                for i, d in enumerate(definitions):
-                    print("{}:\t{}".format(i, d))
-            else:
-                for d in definitions:
-                    print(d)
\ No newline at end of file
+    __print_result(result, PARAM_VERBOSE, PARAM_RAW)
+    if looked_up_locally.is_set():
+        __cache_evict()
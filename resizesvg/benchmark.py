@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# Compare the throughput of resizesvg's attribute rewriting against the
+# original implementation on synthetic SVGs
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import resizesvg  # noqa: E402
+
+# Original implementation, which logged through the root logger at DEBUG
+legacy_log = logging.getLogger("legacy")
+
+
+def _legacy_set_new(elem, attr_name, ratio):
+    old_val_str = elem.attrib[attr_name]
+    old_val = float(old_val_str)
+    new_val = old_val * ratio
+    if '.' in old_val_str or ',' in old_val_str:
+        new_val = "{0:.2f}".format(round(new_val, 2))
+    else:
+        new_val = round(new_val)
+    elem.set(attr_name,  str(new_val))
+    legacy_log.debug("Resizing '{}' from '{}' to '{}'".format(
+        attr_name, old_val, new_val))
+
+
+def _legacy_resize_element(elem, ratio_width, ratio_height):
+    if elem is None:
+        return
+    tag_name = elem.tag
+    legacy_log.info("Processing element {}".format(tag_name))
+    if "x" in elem.attrib:              _legacy_set_new(elem, "x",         ratio_width)
+    if "cx" in elem.attrib:             _legacy_set_new(elem, "cx",        ratio_width)
+    if "x1" in elem.attrib:             _legacy_set_new(elem, "x1",        ratio_width)
+    if "x2" in elem.attrib:             _legacy_set_new(elem, "x2",        ratio_width)
+    if "y" in elem.attrib:              _legacy_set_new(elem, "y",         ratio_height)
+    if "cy" in elem.attrib:             _legacy_set_new(elem, "cy",        ratio_height)
+    if "y1" in elem.attrib:             _legacy_set_new(elem, "y1",        ratio_height)
+    if "y2" in elem.attrib:             _legacy_set_new(elem, "y2",        ratio_height)
+    if "width" in elem.attrib:          _legacy_set_new(elem, "width",     ratio_width)
+    if "height" in elem.attrib:         _legacy_set_new(elem, "height",    ratio_height)
+    if "stroke-width" in elem.attrib:   _legacy_set_new(elem, "stroke-width",  ratio_width)
+    if "r" in elem.attrib:              _legacy_set_new(elem, "r", ratio_width)
+    for child in elem:
+        _legacy_resize_element(child, ratio_width, ratio_height)
+
+
+def _synthetic_svg(count):
+    """SVG document with count shapes of the kinds the original handled"""
+    rand = random.Random(count)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="1000" height="1000">']
+    for i in range(count):
+        kind = i % 3
+        if kind == 0:
+            parts.append('<rect x="{:.4f}" y="{:.4f}" width="{}" height="{}" '
+                         'fill="#E57373" stroke-width="10" stroke="#424242"/>'.format(
+                             rand.uniform(0, 1000), rand.uniform(0, 1000),
+                             rand.randint(1, 100), rand.randint(1, 100)))
+        elif kind == 1:
+            parts.append('<circle cx="{:.4f}" cy="{:.4f}" r="5" '
+                         'stroke-width="0" fill="#d84415"/>'.format(
+                             rand.uniform(0, 1000), rand.uniform(0, 1000)))
+        else:
+            parts.append('<line x1="{:.4f}" y1="{:.4f}" x2="{}" y2="{}" '
+                         'stroke-width="10" stroke="#d84415"/>'.format(
+                             rand.uniform(0, 1000), rand.uniform(0, 1000),
+                             rand.randint(0, 1000), rand.randint(0, 1000)))
+    parts.append("</svg>")
+    return "\n".join(parts)
+
+
+def _time(resize, text):
+    root = ET.fromstring(text)
+    started = time.perf_counter()
+    resize(root)
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="SVG resizer benchmark")
+    parser.add_argument("-n", "--sizes", help="comma separated element counts",
+                        default="10000,100000,1000000")
+    args = parser.parse_args()
+
+    # Both implementations log into the void, as the CLI does by default
+    handler = logging.StreamHandler(open(os.devnull, "w"))
+    root_log = logging.getLogger()
+    root_log.addHandler(handler)
+
+    print("{:>10} {:>14} {:>14} {:>8}".format(
+        "elements", "legacy el/s", "table el/s", "speedup"))
+    for count in [int(n) for n in args.sizes.split(",")]:
+        text = _synthetic_svg(count)
+
+        root_log.setLevel(logging.DEBUG)
+        legacy = _time(lambda root: _legacy_resize_element(root, 2.0, 1.5), text)
+
+        root_log.setLevel(logging.INFO)
+        resizer = resizesvg._Resizer(2.0, 1.5)
+        table = _time(resizer.rewrite_tree, text)
+
+        print("{:>10} {:>14.0f} {:>14.0f} {:>7.1f}x".format(
+            count, count / legacy, count / table, legacy / table))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,117 +1,909 @@
+#!/usr/bin/env python3
+# Resize SVG images by rescaling their coordinates
+# Usable from the command line or imported, through resize() for documents
+# in memory, resize_tree() for element trees and resize_stream() for files
+
 import argparse
 import xml.etree.ElementTree as ET
+import xml.sax
+import glob
+import hashlib
+import io
 import logging
+import os
+import re
+import shutil
 import sys
-from datetime import datetime
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from functools import partial
 from os import path
+from xml.sax.handler import feature_namespaces
+from xml.sax.saxutils import XMLFilterBase, XMLGenerator
+from xml.sax.xmlreader import AttributesNSImpl
 
-if not __name__ == "__main__":
-    sys.stderr.write("File must be run as the main module")
+# Write the usual SVG prefixes instead of generated ns0, ns1...
+ET.register_namespace("", "http://www.w3.org/2000/svg")
+ET.register_namespace("xlink", "http://www.w3.org/1999/xlink")
 
 # Logging
 FORMAT = '%(asctime)s %(levelname)s %(message)s'
-log = logging.getLogger()
-log.setLevel(logging.DEBUG)
-
-sh = logging.StreamHandler(stream=sys.stdout)
-sf = logging.Formatter(fmt=FORMAT)
-sh.setFormatter(sf)
-log.addHandler(sh)
-
-# Arguments
-parser = argparse.ArgumentParser(prog="SVG resizer")
-parser.add_argument("file", help="SVG file")
-parser.add_argument("w", help="New width")
-parser.add_argument("h", help="New height")
-parser.add_argument("-o", "--output", help="Output file name")
-parser.add_argument("-r", "--round", help="max digits to round to",
-                    action="store", default=2, type=int)
-parser.add_argument("-s", "--stroke", help="force new stroke width",
-                    action="store", default=None, type=int)
-args = parser.parse_args()
-
-FILE = args.file
-OUTFILE = args.output
-W = int(args.w)
-H = int(args.h)
-ROUND = args.round
-STROKE = args.stroke
-
-log.debug("Starting")
-
-if not path.exists(FILE):
-    log.error("File does not exists")
-    exit(1)
-
-outfile = OUTFILE if OUTFILE is not None else "{}_resized.svg".format(
-    path.splitext(FILE)[0])
-
-if path.exists(outfile):
-    log.error("Outfile exists already")
-    exit(1)
-
-tree = ET.parse(FILE)
-root = tree.getroot()
-
-if "svg" not in root.tag or "width" not in root.attrib or "height" not in root.attrib:
-    log.error("Invalid SVG")
-    exit(1)
-
-ROOT_WIDTH = int(root.attrib["width"])
-ROOT_HEIGHT = int(root.attrib["height"])
-
-# Calculate scaling ratio
-RATIO_WIDTH = W / ROOT_WIDTH
-RATIO_HEIGHT = H / ROOT_HEIGHT
-
-log.debug("W ratio {}".format(RATIO_WIDTH))
-log.debug("H ratio {}".format(RATIO_HEIGHT))
-
-
-def _set_new(elem, attr_name, ratio):
-    old_val_str = elem.attrib[attr_name]
-    old_val = float(old_val_str)
-    new_val = old_val * ratio
-    if '.' in old_val_str or ',' in old_val_str:
-        new_val = "{0:.2f}".format(round(new_val, 2))
+log = logging.getLogger(__name__)
+
+# Attributes scaled on every element and the axis they belong to
+WIDTH_ATTRIBUTES = ("x", "cx", "x1", "x2", "width", "stroke-width", "r",
+                    "rx", "font-size")
+HEIGHT_ATTRIBUTES = ("y", "cy", "y1", "y2", "height", "ry")
+
+# Kinds of numbers in attribute values, the first five index the ratios
+# of a _Resizer
+_X = 0
+_Y = 1
+_KEEP = 2
+_Y_PER_X = 3
+_X_PER_Y = 4
+_FLAG = 5
+
+# Arguments of each path command, repeated for implicit commands
+PATH_COMMANDS = {
+    "M": (_X, _Y),
+    "L": (_X, _Y),
+    "T": (_X, _Y),
+    "H": (_X,),
+    "V": (_Y,),
+    "C": (_X, _Y, _X, _Y, _X, _Y),
+    "S": (_X, _Y, _X, _Y),
+    "Q": (_X, _Y, _X, _Y),
+    "A": (_X, _Y, _KEEP, _FLAG, _FLAG, _X, _Y),
+    "Z": (),
+}
+PATH_COMMANDS.update({k.lower(): v for k, v in PATH_COMMANDS.items()})
+
+# Arguments of the transform functions which depend on the scaling.
+# Matrices are conjugated with the scaling so that they keep their effect
+# in the resized coordinate system. Rotations and skews are only exact
+# when the aspect ratio is kept.
+TRANSFORM_ARGUMENTS = {
+    "matrix": (_KEEP, _Y_PER_X, _X_PER_Y, _KEEP, _X, _Y),
+    "translate": (_X, _Y),
+    "rotate": (_KEEP, _X, _Y),
+}
+
+_SEPARATORS = " \t\r\n,"
+# Units of lengths that scale with the coordinates. Relative ones such as
+# % and em follow an already scaled value
+_ABSOLUTE_UNITS = ("", "px", "pt", "pc", "mm", "cm", "in")
+_DIGITS = "0123456789"
+
+
+def _scan_number(text, start):
+    """Return the index where the number starting at text[start] ends.
+
+    Implements the number grammar of SVG path data, so "1.5.5" and "1-2"
+    are two numbers each. Scans forward only, nothing ever backtracks."""
+    end = len(text)
+    i = start
+    if i < end and text[i] in "+-":
+        i += 1
+    digits = i
+    while i < end and text[i] in _DIGITS:
+        i += 1
+    if i < end and text[i] == ".":
+        i += 1
+        while i < end and text[i] in _DIGITS:
+            i += 1
+    if i == digits or text[digits:i] == ".":
+        raise ValueError("Invalid number in '{}'".format(text))
+    if i < end and text[i] in "eE":
+        j = i + 1
+        if j < end and text[j] in "+-":
+            j += 1
+        if j < end and text[j] in _DIGITS:
+            while j < end and text[j] in _DIGITS:
+                j += 1
+            i = j
+    return i
+
+
+def _read_length(value):
+    """Read a unitless or pixel length of the root element"""
+    end = _scan_number(value, 0)
+    if value[end:] not in ("", "px"):
+        raise ValueError("Unsupported root size '{}'".format(value))
+    return float(value[:end])
+
+
+def _escape(text):
+    return text.replace("{", "{{").replace("}", "}}")
+
+
+# Attribute values are compiled into a format template and a tuple of
+# (value, kind, decimal) slots for the numbers that need scaling
+
+def _compile_length(value, kind):
+    stripped = value.strip()
+    try:
+        end = _scan_number(stripped, 0)
+    except ValueError:
+        # Keywords such as inherit or auto have nothing to scale
+        return _escape(value), ()
+    unit = stripped[end:]
+    if unit not in _ABSOLUTE_UNITS:
+        return _escape(value), ()
+    token = stripped[:end]
+    return "{}" + _escape(unit), ((float(token), kind, '.' in token),)
+
+
+def _compile_path(d):
+    """Compile path data in a single pass"""
+    parts = []
+    numbers = []
+    args = ()
+    arg = 0
+    i = 0
+    end = len(d)
+    while i < end:
+        c = d[i]
+        if c in _SEPARATORS:
+            i += 1
+            continue
+        if c in PATH_COMMANDS:
+            parts.append(c)
+            args = PATH_COMMANDS[c]
+            arg = 0
+            i += 1
+            continue
+        if not args:
+            raise ValueError("Invalid path data '{}'".format(d))
+        kind = args[arg]
+        if kind == _FLAG:
+            if c not in "01":
+                raise ValueError("Invalid arc flag in '{}'".format(d))
+            parts.append(c)
+            i += 1
+        else:
+            j = _scan_number(d, i)
+            token = d[i:j]
+            if kind == _KEEP:
+                parts.append(token)
+            else:
+                parts.append("{}")
+                numbers.append((float(token), kind, '.' in token))
+            i = j
+        arg = (arg + 1) % len(args)
+    return " ".join(parts), tuple(numbers)
+
+
+def _compile_numbers(value, kinds):
+    """Compile a list of numbers, kinds repeat over the whole list"""
+    parts = []
+    numbers = []
+    arg = 0
+    i = 0
+    end = len(value)
+    while i < end:
+        if value[i] in _SEPARATORS:
+            i += 1
+            continue
+        j = _scan_number(value, i)
+        token = value[i:j]
+        kind = kinds[arg]
+        if kind == _KEEP:
+            parts.append(token)
+        else:
+            parts.append("{}")
+            numbers.append((float(token), kind, '.' in token))
+        arg = (arg + 1) % len(kinds)
+        i = j
+    return " ".join(parts), tuple(numbers)
+
+
+def _compile_points(points):
+    return _compile_numbers(points, (_X, _Y))
+
+
+def _compile_transform(transform):
+    """Compile the arguments of a transform list"""
+    parts = []
+    numbers = []
+    i = 0
+    end = len(transform)
+    while i < end:
+        if transform[i] in _SEPARATORS:
+            i += 1
+            continue
+        start = transform.find("(", i)
+        stop = transform.find(")", start)
+        if start < 0 or stop < 0:
+            raise ValueError("Invalid transform '{}'".format(transform))
+        name = transform[i:start].strip()
+        args = transform[start + 1:stop]
+        if name in TRANSFORM_ARGUMENTS:
+            args, arg_numbers = _compile_numbers(
+                args, TRANSFORM_ARGUMENTS[name] + (_KEEP,))
+            numbers.extend(arg_numbers)
+        else:
+            args = _escape(args)
+        parts.append("{}({})".format(_escape(name), args))
+        i = stop + 1
+    return " ".join(parts), tuple(numbers)
+
+
+# Attributes rewritten on every element and the functions compiling them
+ATTRIBUTES = {
+    "d": _compile_path,
+    "points": _compile_points,
+    "viewBox": _compile_points,
+    "transform": _compile_transform,
+    "gradientTransform": _compile_transform,
+    "patternTransform": _compile_transform,
+}
+ATTRIBUTES.update(dict.fromkeys(
+    WIDTH_ATTRIBUTES, partial(_compile_length, kind=_X)))
+ATTRIBUTES.update(dict.fromkeys(
+    HEIGHT_ATTRIBUTES, partial(_compile_length, kind=_Y)))
+
+
+class _Resizer:
+    """Rewrites attribute values for one pair of scaling ratios.
+
+    `table` maps every attribute name that needs rewriting to the function
+    rewriting its value, so each element only costs a dict lookup per
+    attribute it actually has."""
+
+    def __init__(self, ratio_width, ratio_height, digits=2, stroke=None):
+        self.ratio_width = ratio_width
+        self.ratio_height = ratio_height
+        self._ratios = (ratio_width, ratio_height, 1,
+                        ratio_height / ratio_width, ratio_width / ratio_height)
+        self._number = "%.{}f".format(digits)
+        self._digits = digits
+        self._debug = log.isEnabledFor(logging.DEBUG)
+
+        self._overrides = {}
+        if stroke is not None:
+            self._overrides["stroke-width"] = str(stroke)
+
+        self.table = {attr_name: partial(self.rewrite, attr_name, compile)
+                      for attr_name, compile in ATTRIBUTES.items()}
+        for attr_name, value in self._overrides.items():
+            self.table[attr_name] = partial(self._override, value)
+
+    @staticmethod
+    def _override(new_value, value):
+        return new_value
+
+    def render(self, attr_name, template, numbers):
+        """Fill a compiled template with the numbers scaled"""
+        if attr_name in self._overrides:
+            return self._overrides[attr_name]
+        ratios = self._ratios
+        if template == "{}":
+            value, kind, decimal = numbers[0]
+            return self._format(value * ratios[kind], decimal)
+        return template.format(*[self._format(value * ratios[kind], decimal)
+                                 for value, kind, decimal in numbers])
+
+    def _format(self, value, decimal):
+        """Format a scaled number with the rounding digits. Integers in the
+        source stay integers as long as the scaled value is one"""
+        if not decimal:
+            rounded = round(value, self._digits)
+            if rounded == int(rounded):
+                return str(int(rounded))
+        return self._number % value
+
+    def rewrite(self, attr_name, compile, value):
+        template, numbers = compile(value)
+        new_value = self.render(attr_name, template, numbers)
+        if self._debug:
+            log.debug("Resizing '%s' from '%s' to '%s'",
+                      attr_name, value, new_value)
+        return new_value
+
+    def rewrite_tree(self, root):
+        """Rewrite every element below and including root in place"""
+        table = self.table
+        for elem in root.iter():
+            attrib = elem.attrib
+            for attr_name, value in attrib.items():
+                rewrite = table.get(attr_name)
+                if rewrite is not None:
+                    attrib[attr_name] = rewrite(value)
+
+
+def _resize_root_only(attrib, w, h):
+    """Resize by rewriting only the root's width, height and viewBox.
+
+    Returns the new root attributes, or None if the result would not look
+    the same as rewriting every coordinate."""
+    root_width = _read_length(attrib["width"])
+    root_height = _read_length(attrib["height"])
+    ratio_width = w / root_width
+    ratio_height = h / root_height
+    new_attrib = {"width": str(w), "height": str(h)}
+    if "viewBox" not in attrib:
+        new_attrib["viewBox"] = "0 0 {} {}".format(
+            attrib["width"].replace("px", ""), attrib["height"].replace("px", ""))
+        if abs(ratio_width - ratio_height) > 1e-9:
+            # Stretch exactly as scaling each coordinate would
+            new_attrib["preserveAspectRatio"] = "none"
+    elif abs(ratio_width - ratio_height) > 1e-9 \
+            and attrib.get("preserveAspectRatio") != "none":
+        return None
+    return new_attrib
+
+
+def _root_only(attrib, w, h, viewbox, stroke):
+    """New root attributes when resizing through the viewBox alone, None when
+    every element has to be rewritten"""
+    if not viewbox:
+        return None
+    if stroke is not None:
+        # Forcing the stroke width needs every element rewritten
+        log.info("Stroke width is forced, rewriting every element")
+        return None
+    new_attrib = _resize_root_only(attrib, w, h)
+    if new_attrib is None:
+        log.info("Aspect ratio changes, rewriting every element")
+    return new_attrib
+
+
+def _get_resizer(attrib, w, h, digits, stroke):
+    """Create the resizer for a root element's attributes"""
+    ratio_width = w / _read_length(attrib["width"])
+    ratio_height = h / _read_length(attrib["height"])
+    log.debug("W ratio %s", ratio_width)
+    log.debug("H ratio %s", ratio_height)
+    return _Resizer(ratio_width, ratio_height, digits, stroke)
+
+
+class _StreamResizer(XMLFilterBase):
+    """SAX filter which rescales attributes as elements stream past.
+
+    Ratios are calculated from the root element, so nothing but the
+    current element is ever held in memory."""
+
+    def __init__(self, parent, w, h, viewbox=False, digits=2, stroke=None):
+        super().__init__(parent)
+        self._w = w
+        self._h = h
+        self._viewbox = viewbox
+        self._digits = digits
+        self._stroke = stroke
+        self._table = None
+
+    def _read_root(self, name, attrs):
+        if name[1] != "svg" or (None, "width") not in attrs \
+                or (None, "height") not in attrs:
+            raise ValueError("Invalid SVG")
+        attrib = {k[1]: v for k, v in attrs.items() if k[0] is None}
+        new_attrib = _root_only(attrib, self._w, self._h, self._viewbox, self._stroke)
+        if new_attrib is not None:
+            # Nothing below the root needs to change
+            self._table = {}
+            return _with_attributes(attrs, new_attrib)
+        self._table = _get_resizer(
+            attrib, self._w, self._h, self._digits, self._stroke).table
+        return None
+
+    def startElementNS(self, name, qname, attrs):
+        if self._table is None:
+            root_attrs = self._read_root(name, attrs)
+            if root_attrs is not None:
+                return super().startElementNS(name, qname, root_attrs)
+        table = self._table
+        if not table:
+            return super().startElementNS(name, qname, attrs)
+        changed = {}
+        for key, value in attrs.items():
+            if key[0] is None:
+                rewrite = table.get(key[1])
+                if rewrite is not None:
+                    changed[key] = rewrite(value)
+        if changed:
+            attrs = _with_attributes(attrs, changed)
+        super().startElementNS(name, qname, attrs)
+
+
+def _with_attributes(attrs, changed):
+    """Copy SAX attributes, replacing values from a dict keyed on either
+    plain attribute names or (uri, name) tuples"""
+    values = dict(attrs.items())
+    qnames = {key: attrs.getQNameByName(key) for key in values}
+    for key, value in changed.items():
+        if not isinstance(key, tuple):
+            qnames.setdefault((None, key), key)
+            key = (None, key)
+        values[key] = value
+    return AttributesNSImpl(values, qnames)
+
+
+def resize_tree(tree, w, h, digits=2, stroke=None, viewbox=False):
+    """Resize an ElementTree, or the root Element of one, in place.
+
+    With viewbox only the root is rewritten when that renders the same as
+    scaling every coordinate. Returns the tree for convenience and raises
+    ValueError if it is not an SVG with a width and height."""
+    root = tree.getroot() if isinstance(tree, ET.ElementTree) else tree
+
+    if "svg" not in root.tag or "width" not in root.attrib or "height" not in root.attrib:
+        raise ValueError("Invalid SVG")
+
+    new_attrib = _root_only(root.attrib, w, h, viewbox, stroke)
+    if new_attrib is not None:
+        log.info("Rewriting only the root element")
+        root.attrib.update(new_attrib)
     else:
-        new_val = round(new_val)
-    elem.set(attr_name,  str(new_val))
-    log.debug("Resizing '{}' from '{}' to '{}'".format(
-        attr_name, old_val, new_val))
+        _get_resizer(root.attrib, w, h, digits, stroke).rewrite_tree(root)
+    log.info("Done resizing")
+    return tree
+
+
+def resize_stream(infile, outfile, w, h, digits=2, stroke=None, viewbox=False):
+    """Resize from infile to outfile without building an element tree.
+
+    Both may be file names or file-like objects, only the element being
+    rewritten is ever held in memory."""
+    _stream_many(infile, [outfile], [(w, h)], digits, stroke, viewbox)
+
+
+def resize(source, w, h, digits=2, stroke=None, viewbox=False, stream=False):
+    """Resize an SVG document in memory and return the result as bytes.
+
+    source is the document as bytes or str, or a file-like object to read
+    it from. With stream the document is rewritten through SAX instead of
+    an element tree."""
+    return resize_many(source, [(w, h)], digits, stroke, viewbox, stream)[0]
+
+
+def resize_many(source, sizes, digits=2, stroke=None, viewbox=False,
+                stream=False):
+    """Resize one document to several (w, h) sizes, parsing it only once.
+
+    source is as for resize(). Returns the results as bytes in the order
+    of sizes."""
+    if isinstance(source, str):
+        source = source.encode("utf-8")
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    outs = [io.BytesIO() for _ in sizes]
+    _resize_many(source, outs, sizes, digits, stroke, viewbox, stream)
+    return [out.getvalue() for out in outs]
+
+
+class _Slots:
+    """Every rewritable value of a tree, compiled once.
 
+    The tree can then be rendered at any number of sizes by filling the
+    compiled templates, without parsing or walking it again."""
 
-def _resize_element(elem):
-    if elem is None:
+    def __init__(self, tree):
+        self.tree = tree
+        self.root = tree.getroot()
+        attrib = self.root.attrib
+        if "svg" not in self.root.tag or "width" not in attrib or "height" not in attrib:
+            raise ValueError("Invalid SVG")
+        self.root_attrib = dict(attrib)
+        self.width = _read_length(attrib["width"])
+        self.height = _read_length(attrib["height"])
+
+        # (attrib, attribute name, original value, template, numbers)
+        self.slots = []
+        for elem in self.root.iter():
+            for attr_name, value in elem.attrib.items():
+                compile = ATTRIBUTES.get(attr_name)
+                if compile is not None:
+                    self.slots.append(
+                        (elem.attrib, attr_name, value) + compile(value))
+
+    def resize(self, w, h, digits=2, stroke=None, viewbox=False):
+        """Render the tree at a new size in place"""
+        root_attrib = self.root.attrib
+        root_attrib.clear()
+        root_attrib.update(self.root_attrib)
+
+        new_attrib = _root_only(root_attrib, w, h, viewbox, stroke)
+        if new_attrib is not None:
+            for attrib, attr_name, value, _, _ in self.slots:
+                attrib[attr_name] = value
+            root_attrib.update(new_attrib)
+            return
+
+        render = _Resizer(w / self.width, h / self.height, digits, stroke).render
+        for attrib, attr_name, _, template, numbers in self.slots:
+            attrib[attr_name] = render(attr_name, template, numbers)
+
+
+class _Tee:
+    """Content handler forwarding every SAX event to several handlers"""
+
+    def __init__(self, handlers):
+        self._handlers = handlers
+
+    def __getattr__(self, name):
+        methods = [getattr(handler, name) for handler in self._handlers]
+
+        def forward(*args):
+            for method in methods:
+                method(*args)
+        # Only look up each event once
+        setattr(self, name, forward)
+        return forward
+
+
+def _stream_many(infile, outfiles, sizes, digits=2, stroke=None, viewbox=False):
+    """Stream infile into an outfile per size through a single parse"""
+    with ExitStack() as stack:
+        resizers = []
+        for (w, h), outfile in zip(sizes, outfiles):
+            if isinstance(outfile, str):
+                outfile = stack.enter_context(open(outfile, "wb"))
+            resizer = _StreamResizer(None, w, h, viewbox, digits, stroke)
+            resizer.setContentHandler(XMLGenerator(
+                outfile, encoding="utf-8", short_empty_elements=True))
+            resizers.append(resizer)
+
+        reader = xml.sax.make_parser()
+        reader.setFeature(feature_namespaces, True)
+        reader.setContentHandler(
+            resizers[0] if len(resizers) == 1 else _Tee(resizers))
+        reader.parse(infile)
+
+
+def _resize_many(infile, outfiles, sizes, digits=2, stroke=None, viewbox=False,
+                 stream=False):
+    if stream:
+        _stream_many(infile, outfiles, sizes, digits, stroke, viewbox)
+    elif len(sizes) == 1:
+        w, h = sizes[0]
+        tree = resize_tree(ET.parse(infile), w, h, digits, stroke, viewbox)
+        _write_tree(tree, outfiles[0])
+    else:
+        slots = _Slots(ET.parse(infile))
+        for (w, h), outfile in zip(sizes, outfiles):
+            slots.resize(w, h, digits, stroke, viewbox)
+            _write_tree(slots.tree, outfile)
+
+
+def _write_tree(tree, outfile):
+    tree.write(outfile, encoding="utf-8")
+
+
+# Part of every cache key, bumped whenever the same input and options start
+# producing different output
+CACHE_FORMAT = 2
+
+
+class _Cache:
+    """Content addressed store of earlier results.
+
+    Entries are keyed on a hash of the input bytes and every option that
+    changes the output. The least recently used entries are evicted once
+    the store grows over max_size bytes."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not path.exists(directory):
+            os.makedirs(directory)
+
+    def keys(self, infile, sizes, options):
+        """Cache key for each size of infile"""
+        digest = hashlib.sha256()
+        with open(infile, "rb") as f:
+            for chunk in iter(partial(f.read, 1 << 20), b""):
+                digest.update(chunk)
+        keys = []
+        for w, h in sizes:
+            key = digest.copy()
+            key.update(repr((CACHE_FORMAT, w, h) + options).encode("utf-8"))
+            keys.append(key.hexdigest())
+        return keys
+
+    def get(self, key, outfile):
+        """Copy a cached result into outfile, returns False on a miss"""
+        entry = path.join(self.directory, key)
+        try:
+            shutil.copyfile(entry, outfile)
+        except FileNotFoundError:
+            return False
+        # Mark as recently used
+        os.utime(entry)
+        return True
+
+    def put(self, key, outfile):
+        entry = path.join(self.directory, key)
+        # Workers may store concurrently, never expose a partial entry
+        temp = "{}.{}.tmp".format(entry, os.getpid())
+        shutil.copyfile(outfile, temp)
+        os.replace(temp, entry)
+
+    def evict(self):
+        """Remove least recently used entries until under max_size"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(entry)
+            total -= size
+
+
+def _resize_file(infile, outfiles, sizes, stream, viewbox=False, digits=2,
+                 stroke=None, cache=None):
+    """Resize a single file.
+
+    Returns the time it took in seconds and how many of the sizes were
+    found from the cache."""
+    started = time.perf_counter()
+    hits = 0
+    try:
+        if cache is not None:
+            keys = cache.keys(infile, sizes, (digits, stroke, viewbox, stream))
+            missing = [i for i, key in enumerate(keys)
+                       if not cache.get(key, outfiles[i])]
+            hits = len(sizes) - len(missing)
+        else:
+            missing = range(len(sizes))
+        if missing:
+            missing_outfiles = [outfiles[i] for i in missing]
+            log.info("Writing into %s", ", ".join(missing_outfiles))
+            _resize_many(infile, missing_outfiles, [sizes[i] for i in missing],
+                         digits, stroke, viewbox, stream)
+            if cache is not None:
+                for i in missing:
+                    cache.put(keys[i], outfiles[i])
+    except Exception as e:
+        # Do not leave half written files around to be skipped on next run
+        for outfile in outfiles:
+            if path.exists(outfile):
+                os.remove(outfile)
+        if isinstance(e, xml.sax.SAXException):
+            # Holds the parser's locator, which cannot be sent between processes
+            raise ValueError(str(e)) from None
+        raise
+    return time.perf_counter() - started, hits
+
+
+def _get_outfiles(file, sizes, outdir=None):
+    base = path.splitext(file)[0]
+    if len(sizes) == 1:
+        names = ["{}_resized.svg".format(base)]
+    else:
+        names = ["{}_{}x{}.svg".format(base, w, h) for w, h in sizes]
+    if outdir is not None:
+        names = [path.join(outdir, path.basename(name)) for name in names]
+    return names
+
+
+def _is_pattern(item):
+    return any(c in item for c in "*?[")
+
+
+def _result_source(file):
+    """The file an earlier run would have written file from, None if the
+    name is not one written by a run"""
+    match = re.search(r"_(resized|\d+x\d+)\.svg$", file)
+    return None if match is None else file[:match.start()] + ".svg"
+
+
+def _expand_inputs(inputs):
+    """Expand directories and glob patterns into a list of SVG files.
+
+    Returns the files and the earlier results left out as (file, source).
+    A match is only taken for an earlier result when the file it would
+    come from is an input too, as names like logo_24x24.svg are common
+    for sources. Files named explicitly are always included"""
+    files = []
+    matched = set()
+    for item in inputs:
+        if path.isdir(item):
+            matches = sorted(glob.glob(path.join(item, "*.svg")))
+        elif _is_pattern(item):
+            matches = sorted(glob.glob(item, recursive=True))
+        else:
+            files.append(item)
+            continue
+        files.extend(matches)
+        matched.update(path.normpath(m) for m in matches)
+    # The same file may be named by several inputs
+    seen = set()
+    unique = []
+    for file in files:
+        key = path.normpath(file)
+        if key not in seen:
+            seen.add(key)
+            unique.append(file)
+
+    kept = []
+    earlier = []
+    for file in unique:
+        source = _result_source(file)
+        key = path.normpath(file)
+        if key in matched and source is not None and path.normpath(source) in seen:
+            earlier.append((file, source))
+        else:
+            kept.append(file)
+    return kept, earlier
+
+
+def _quiet_worker():
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+def _resize_batch(files, outdir, sizes, stream, viewbox, digits, stroke, jobs,
+                  cache=None, earlier=()):
+    """Resize files over a process pool. earlier lists the inputs left
+    out as (file, source), as results of an earlier run.
+
+    Returns the number of failures and the number of cache hits and
+    misses."""
+    if outdir is not None and not path.exists(outdir):
+        os.makedirs(outdir)
+
+    failed = 0
+    skipped = len(earlier)
+    for file, source in earlier:
+        log.warning("SKIPPED %s: Earlier result of %s", file, source)
+    hits = 0
+    misses = 0
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_quiet_worker) as pool:
+        futures = {}
+        # Output paths taken by earlier files, inputs with the same name in
+        # different directories collide in outdir
+        claimed = {}
+        for file in files:
+            outfiles = _get_outfiles(file, sizes, outdir)
+            clashes = [claimed[path.normpath(outfile)] for outfile in outfiles
+                       if path.normpath(outfile) in claimed]
+            if clashes:
+                log.error("FAILED %s: Same output file as %s", file, clashes[0])
+                failed += 1
+                continue
+            claimed.update((path.normpath(outfile), file) for outfile in outfiles)
+            if not path.exists(file):
+                log.error("FAILED %s: File does not exists", file)
+                failed += 1
+            elif any(path.exists(outfile) for outfile in outfiles):
+                log.warning("SKIPPED %s: Outfile exists already", file)
+                skipped += 1
+            else:
+                future = pool.submit(_resize_file, file, outfiles, sizes,
+                                     stream, viewbox, digits, stroke, cache)
+                futures[future] = (file, outfiles)
+
+        for future in as_completed(futures):
+            file, outfiles = futures[future]
+            try:
+                elapsed, file_hits = future.result()
+            except Exception as e:
+                log.error("FAILED %s: %s", file, e)
+                failed += 1
+                continue
+            log.info("OK %s -> %s (%.3fs)", file, ", ".join(outfiles), elapsed)
+            hits += file_hits
+            misses += len(sizes) - file_hits
+
+    total = len(files) + len(earlier)
+    log.info("Resized %d of %d files in %.3fs, %d skipped, %d failed",
+             total - failed - skipped, total,
+             time.perf_counter() - started, skipped, failed)
+    return failed, hits, misses
+
+
+def _finish_cache(cache, stats, hits, misses):
+    if cache is None:
         return
-    tag_name = elem.tag
-    log.info("Processing element {}".format(tag_name))
-    if "x" in elem.attrib:              _set_new(elem, "x",         RATIO_WIDTH)
-    if "cx" in elem.attrib:             _set_new(elem, "cx",        RATIO_WIDTH)
-    if "x1" in elem.attrib:             _set_new(elem, "x1",        RATIO_WIDTH)
-    if "x2" in elem.attrib:             _set_new(elem, "x2",        RATIO_WIDTH)
-    if "y" in elem.attrib:              _set_new(elem, "y",         RATIO_HEIGHT)
-    if "cy" in elem.attrib:             _set_new(elem, "cy",        RATIO_HEIGHT)
-    if "y1" in elem.attrib:             _set_new(elem, "y1",        RATIO_HEIGHT)
-    if "y2" in elem.attrib:             _set_new(elem, "y2",        RATIO_HEIGHT)
-    if "width" in elem.attrib:          _set_new(elem, "width",     RATIO_WIDTH)
-    if "height" in elem.attrib:         _set_new(elem, "height",    RATIO_HEIGHT)
-    if "stroke-width" in elem.attrib:   _set_new(elem, "stroke-width",  RATIO_WIDTH)
-    if "r" in elem.attrib:              _set_new(elem, "r", RATIO_WIDTH)
-    # Recurse
-    for child in elem:
-        _resize_element(child)
-
-
-_resize_element(root)
-log.info("Done resizing")
-
-# Flush to a new file
-log.info("Writing into {}".format(outfile))
-tree.write(outfile)
-with open(outfile, "r+") as f:
-    text = f.read()
-    f.seek(0)
-    f.write(text.replace("ns0:", "").replace(":ns0", ""))
-    f.truncate()
-log.info("All done")
+    cache.evict()
+    if stats:
+        log.info("Cache: %d hits, %d misses", hits, misses)
+
+
+def main():
+    # Arguments
+    parser = argparse.ArgumentParser(prog="SVG resizer", fromfile_prefix_chars="@")
+    parser.add_argument("file", nargs="+",
+                        help="SVG file, or in batch mode several files, "
+                        "directories, glob patterns or an @manifest file")
+    parser.add_argument("w", help="New width, or comma separated widths "
+                        "to write several sizes from one parse")
+    parser.add_argument("h", help="New height, or comma separated heights "
+                        "matching the widths")
+    parser.add_argument("-o", "--output",
+                        help="Output file name, or output directory in batch "
+                        "mode and with several sizes")
+    parser.add_argument("-r", "--round", help="max digits to round to",
+                        action="store", default=2, type=int)
+    parser.add_argument("-s", "--stroke", help="force new stroke width",
+                        action="store", default=None, type=int)
+    parser.add_argument("--stream", help="stream the file instead of loading it "
+                        "into memory, for very large files", action="store_true")
+    parser.add_argument("--viewbox", help="only rewrite the root's size and "
+                        "viewBox when the result looks the same", action="store_true")
+    parser.add_argument("-j", "--jobs", help="worker processes in batch mode",
+                        action="store", default=os.cpu_count(), type=int)
+    parser.add_argument("--cache", help="reuse results of earlier runs with "
+                        "the same input and options", action="store_true")
+    parser.add_argument("--cache-dir", help="cache directory",
+                        default=path.join(os.environ.get(
+                            "XDG_CACHE_HOME", path.expanduser("~/.cache")),
+                            "resizesvg"))
+    parser.add_argument("--cache-size", help="max cache size in megabytes",
+                        action="store", default=256, type=int)
+    parser.add_argument("--cache-stats", help="report cache hits and misses",
+                        action="store_true")
+    parser.add_argument("-v", "--verbose", help="log every resized value",
+                        action="store_true")
+    args = parser.parse_args()
+
+    FILES = args.file
+    OUTFILE = args.output
+    WIDTHS = [int(w) for w in args.w.split(",")]
+    HEIGHTS = [int(h) for h in args.h.split(",")]
+    ROUND = args.round
+    STROKE = args.stroke
+    STREAM = args.stream
+    VIEWBOX = args.viewbox
+    JOBS = args.jobs
+    CACHE = _Cache(args.cache_dir, args.cache_size * 1024 * 1024) \
+        if args.cache else None
+
+    if len(WIDTHS) != len(HEIGHTS):
+        parser.error("give as many widths as heights")
+    SIZES = list(zip(WIDTHS, HEIGHTS))
+
+    # Logging
+    root_log = logging.getLogger()
+    root_log.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    sh = logging.StreamHandler(stream=sys.stdout)
+    sf = logging.Formatter(fmt=FORMAT)
+    sh.setFormatter(sf)
+    root_log.addHandler(sh)
+
+    log.debug("Starting")
+
+    if len(FILES) > 1 or any(path.isdir(f) or _is_pattern(f) for f in FILES):
+        files, earlier = _expand_inputs(FILES)
+        failed, hits, misses = _resize_batch(
+            files, OUTFILE, SIZES, STREAM, VIEWBOX, ROUND, STROKE, JOBS, CACHE,
+            earlier)
+        _finish_cache(CACHE, args.cache_stats, hits, misses)
+        exit(1 if failed > 0 else 0)
+
+    FILE = FILES[0]
+
+    if not path.exists(FILE):
+        log.error("File does not exists")
+        exit(1)
+
+    if OUTFILE is not None and len(SIZES) == 1:
+        outfiles = [OUTFILE]
+    else:
+        outfiles = _get_outfiles(FILE, SIZES, OUTFILE)
+        if OUTFILE is not None and not path.exists(OUTFILE):
+            os.makedirs(OUTFILE)
+
+    if any(path.exists(outfile) for outfile in outfiles):
+        log.error("Outfile exists already")
+        exit(1)
+
+    try:
+        _, hits = _resize_file(FILE, outfiles, SIZES, STREAM, VIEWBOX, ROUND,
+                               STROKE, CACHE)
+    except (ValueError, ET.ParseError, xml.sax.SAXException) as e:
+        log.error(e)
+        exit(1)
+    _finish_cache(CACHE, args.cache_stats, hits, len(SIZES) - hits)
+    log.info("All done")
+
+
+if __name__ == "__main__":
+    main()
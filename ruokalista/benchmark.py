@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Measure getfudd's cache decoding against jsonpickle, and the cold and warm
+# start time of the CLI against a local copy of the menu page.
+# Pass --against with an older getfudd.py, for example one written out with
+# `git show <commit>:ruokalista/getfudd.py`, to time it side by side.
+# Exits with an error when the warm start takes more than --target ms over a
+# bare interpreter start
+
+import argparse
+import http.server
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import getfudd  # noqa: E402
+
+_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "getfudd.py")
+
+
+class _LegacyMeal:
+    def __init__(self, name, price=-1):
+        self.name = name
+        self.price = price
+
+
+class _LegacyRestaurant:
+    def __init__(self, name):
+        self.name = name
+        self.meals = list()
+
+
+def _synthetic_page(restaurants, meals):
+    """Menu page shaped like murkinat's"""
+    parts = ['<html><body><div class="restaurants">']
+    for i in range(restaurants):
+        parts.append('<div class="restaurant"><h3 class="restaurantName">Ravintola {}</h3>'
+                     '<table class="meals">'.format(i))
+        for j in range(meals):
+            parts.append('<tr class="meal"><td class="mealName">Ateria {} {}</td><td class="mealPrices">'
+                         '<span class="mealPrice">2,70</span><span class="mealPrice">5,10</span>'
+                         '</td></tr>'.format(i, j))
+        parts.append('</table></div>')
+    parts.append('</div></body></html>')
+    return "".join(parts).encode("utf-8")
+
+
+def _serve(body):
+    """Serve body on a local port, returns its URL"""
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}/".format(server.server_port)
+
+
+def _time_decode(rounds, page):
+    """Seconds per decode of the page with jsonpickle and with getfudd"""
+    import jsonpickle
+    legacy = []
+    for rest in page.restaurants():
+        legacy_rest = _LegacyRestaurant(rest.name)
+        legacy_rest.meals = [_LegacyMeal(m.name, m.price) for m in rest.meals]
+        legacy.append(legacy_rest)
+    legacy_encoded = jsonpickle.encode(legacy)
+    encoded = getfudd._encode_page(page)
+
+    started = time.perf_counter()
+    for _ in range(rounds):
+        jsonpickle.decode(legacy_encoded)
+    legacy_time = (time.perf_counter() - started) / rounds
+    started = time.perf_counter()
+    for _ in range(rounds):
+        getfudd._decode_page(encoded)
+    return legacy_time, (time.perf_counter() - started) / rounds
+
+
+def _time_interpreter(rounds):
+    """Median seconds to start and stop a bare interpreter"""
+    times = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - started)
+    return statistics.median(times)
+
+
+def _time_start(script, url, rounds, warm):
+    """Median seconds to run script against url, with or without a warm cache"""
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, HOME=home)
+    command = [sys.executable, script, "-u", url]
+    times = []
+    try:
+        if warm:
+            subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+        for _ in range(rounds):
+            if not warm:
+                shutil.rmtree(os.path.join(home, ".config"), ignore_errors=True)
+            started = time.perf_counter()
+            subprocess.run(command, env=env, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL, check=True)
+            times.append(time.perf_counter() - started)
+    finally:
+        shutil.rmtree(home)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="getfudd benchmark")
+    parser.add_argument("-n", "--rounds", type=int, default=20, help="runs per measurement")
+    parser.add_argument("-a", "--against", help="older getfudd.py to compare with")
+    parser.add_argument("-t", "--target", type=float, default=40,
+                        help="allowed warm start in ms over a bare interpreter")
+    parser.add_argument("--restaurants", type=int, default=12)
+    parser.add_argument("--meals", type=int, default=8)
+    args = parser.parse_args()
+
+    content = _synthetic_page(args.restaurants, args.meals)
+    page = getfudd._Page()
+    page.blocks = list(getfudd._parse_page(content))
+    legacy, current = _time_decode(args.rounds * 10, page)
+    print("cache decode: jsonpickle {:.3f} ms, current {:.3f} ms, {:.1f}x".format(
+        legacy * 1000, current * 1000, legacy / current))
+
+    url = _serve(content)
+    scripts = [("current", _SCRIPT)]
+    if args.against is not None:
+        scripts.append(("against", args.against))
+    interpreter = _time_interpreter(args.rounds)
+    print("interpreter start {:.1f} ms".format(interpreter * 1000))
+    print("{:>10} {:>10} {:>10}".format("script", "cold ms", "warm ms"))
+    for name, script in scripts:
+        cold = _time_start(script, url, args.rounds, False)
+        warm = _time_start(script, url, args.rounds, True)
+        print("{:>10} {:>10.1f} {:>10.1f}".format(name, cold * 1000, warm * 1000))
+        if script == _SCRIPT:
+            current_warm = warm
+
+    overhead = (current_warm - interpreter) * 1000
+    if overhead > args.target:
+        print("Warm start is {:.1f} ms over the interpreter, target is {:.1f} ms".format(
+            overhead, args.target), file=sys.stderr)
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
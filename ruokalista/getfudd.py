@@ -1,14 +1,17 @@
 #!/usr/bin/env python3
 # Get food list for Unica's restaurants
 # Can be filtered by restaurant or meals searched with regex
+# Importable too, get_restaurants and iter_restaurants return the menus
 
-import urllib3
+import argparse
+import bisect
 import sys
 import re
-from bs4 import BeautifulSoup
 import datetime
 import os
-import jsonpickle
+import json
+import random
+import time
 
 # Default base URL
 URL = "https://murkinat.appspot.com/"
@@ -19,7 +22,7 @@ DEBUG = False
 _SEARCH = None
 _RESTAURANT = None
 
-# Restaurant IDs and their matching string on the website
+# Restaurant IDs and their matching string on murkinat
 RESTAURANTS = {
     "assari": "Assarin Ullakko",
     "brygge": "Brygge",
@@ -31,10 +34,24 @@ RESTAURANTS = {
 # Get current day for caching
 _CURRENT_DATE = datetime.date.today()
 _CACHE_DAYS = 7
-_CACHED_RESTAURANTS = None
 _HOME_DIR = os.path.expanduser("~")
 _CONFIG_DIR = _HOME_DIR + "/.config/ruokalista/"
 _FILE_PREFIX = "ruokalista"
+_FILE_SUFFIX = ".json"
+_CACHE_VERSION = 1
+_SOURCES_FILE = "sources.json"
+_HISTORY_FILE = "history.json"
+_HISTORY_DAYS = 8 * 7
+
+# Prefetch schedule, shortly after the menus are published and then every
+# _PREFETCH_INTERVAL seconds until lunch is over. Each run is delayed by up
+# to _PREFETCH_JITTER seconds, failed runs are retried after a backoff
+# doubling from _PREFETCH_BACKOFF seconds
+_PREFETCH_START = datetime.time(6, 30)
+_PREFETCH_END = datetime.time(14, 0)
+_PREFETCH_INTERVAL = 60 * 60
+_PREFETCH_JITTER = 5 * 60
+_PREFETCH_BACKOFF = 60
 
 
 class _BCOLORS:
@@ -50,17 +67,62 @@ class _BCOLORS:
 
 
 class Meal:
+    __slots__ = ("name", "price")
+
     def __init__(self, name, price=-1):
         self.name = name
         self.price = price
 
 
 class Restaurant:
+    __slots__ = ("name", "meals")
+
     def __init__(self, name):
         self.name = name
         self.meals = list()
 
 
+class _Page:
+    """Restaurants parsed from the page along with the response validators
+    and the hash of the HTML block each restaurant was parsed from"""
+    __slots__ = ("etag", "last_modified", "blocks")
+
+    def __init__(self, etag=None, last_modified=None):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.blocks = list()
+
+    def restaurants(self):
+        return [r for _, r in self.blocks if r is not None]
+
+
+class Source:
+    """Site to scrape menus from. parser is the ID of the site's page parser
+    in PARSERS, timeout is in seconds and restaurants maps restaurant IDs to
+    their names on the site"""
+    __slots__ = ("name", "url", "parser", "timeout", "restaurants")
+
+    def __init__(self, name, url, parser, timeout=10, restaurants=None):
+        self.name = name
+        self.url = url
+        self.parser = parser
+        self.timeout = timeout
+        self.restaurants = restaurants if restaurants is not None else dict()
+
+
+# Built-in sources by ID, more can be configured in _SOURCES_FILE
+SOURCES = {
+    "murkinat": Source("murkinat", URL, "murkinat", 10, RESTAURANTS),
+}
+
+
+# Opening tag of the restaurant list and of a single restaurant in it
+_RESTAURANTS_START = re.compile(
+    rb"""<div\b[^>]*\bclass\s*=\s*["']?(?:[^"'>]*\s)?restaurants[\s"'>]""")
+_RESTAURANT_START = re.compile(
+    rb"""<div\b[^>]*\bclass\s*=\s*["']?(?:[^"'>]*\s)?restaurant[\s"'>]""")
+
+
 def _check_config_dir():
     """Create configuration directory if it does not exists already"""
     global _CONFIG_DIR
@@ -68,40 +130,227 @@ def _check_config_dir():
         os.makedirs(_CONFIG_DIR)
 
 
-def _read_cache():
-    """Read scraped info from cache"""
-    global _CACHE_DAYS, _CURRENT_DATE, _CACHED_RESTAURANTS, _CONFIG_DIR, _FILE_PREFIX
-    _check_config_dir()
+def _encode_page(page):
+    """Encode page as a versioned document of plain JSON arrays"""
+    blocks = []
+    for block_hash, rest in page.blocks:
+        if rest is not None:
+            rest = [rest.name, [[m.name, m.price] for m in rest.meals]]
+        blocks.append([block_hash, rest])
+    return json.dumps([_CACHE_VERSION, page.etag, page.last_modified, blocks],
+                      ensure_ascii=False, separators=(",", ":"))
+
+
+def _decode_page(encoded):
+    """Decode page encoded with _encode_page, raises ValueError on an
+    unknown version"""
+    version, etag, last_modified, blocks = json.loads(encoded)
+    if version != _CACHE_VERSION:
+        raise ValueError("Unknown cache version {}".format(version))
+    page = _Page(etag, last_modified)
+    for block_hash, rest in blocks:
+        if rest is not None:
+            name, meals = rest
+            rest = Restaurant(name)
+            rest.meals = [Meal(meal_name, price) for meal_name, price in meals]
+        page.blocks.append((block_hash, rest))
+    return page
+
+
+def _cache_path(date, source):
+    """Path of the cache file of a source for a day"""
+    return _CONFIG_DIR + _FILE_PREFIX + str(date) + "-" + source + _FILE_SUFFIX
+
+
+def _cache_files():
+    """Cache files as (date, source, file name), oldest first. The source is
+    None for files from before sources were cached separately"""
+    files = []
+    if not os.path.isdir(_CONFIG_DIR):
+        # Nothing has been cached yet
+        return files
     for file in os.listdir(_CONFIG_DIR):
         file_date_re = re.match(
-            _FILE_PREFIX + r"(\d{4})-(\d{2})-(\d{2})", file)
-        if file_date_re is not None and len(file_date_re.groups()) == 3:
+            _FILE_PREFIX + r"(\d{4})-(\d{2})-(\d{2})(?:-(.+)" + re.escape(_FILE_SUFFIX) + ")?$", file)
+        if file_date_re is not None:
             re_matches = file_date_re.groups()
-            file_date = datetime.date(int(re_matches[0]), int(
-                re_matches[1]), int(re_matches[2]))
-            if (_CURRENT_DATE - file_date).days > _CACHE_DAYS:
-                os.remove(file)
-            if _CURRENT_DATE == file_date:
-                # Read cache
-                with open(_CONFIG_DIR + file, mode="r") as f:
-                    try:
-                        obj_encoded = f.read()
-                        _CACHED_RESTAURANTS = jsonpickle.decode(obj_encoded)
-                    except:
-                        _eprint("Failed to deserialize object from " + file)
-                        _CACHED_RESTAURANTS = None
-
-
-def _write_cache(obj):
-    """Write parsed object to cache"""
+            try:
+                file_date = datetime.date(int(re_matches[0]), int(
+                    re_matches[1]), int(re_matches[2]))
+            except ValueError:
+                continue
+            files.append((file_date, re_matches[3], file))
+    return sorted(files, key=lambda f: (f[0], f[2]))
+
+
+def _read_page(file_path):
+    """Read cached page from file, None if missing or unreadable"""
+    try:
+        with open(file_path, mode="r", encoding="utf-8") as f:
+            return _decode_page(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError):
+        _eprint("Failed to deserialize object from " + file_path)
+        return None
+
+
+def _read_cache(source):
+    """Read today's page of a source from cache. Only opens today's file, so
+    a warm start does not list or touch the rest of the cache"""
+    return _read_page(_cache_path(_CURRENT_DATE, source))
+
+
+def _read_latest_cache(source):
+    """Read the latest earlier page of a source for revalidating it when
+    today's page is not cached"""
+    if not os.path.isdir(_CONFIG_DIR):
+        return None
+    for file_date, file_source, file in reversed(_cache_files()):
+        if file_date < _CURRENT_DATE and file_source == source:
+            page = _read_page(_CONFIG_DIR + file)
+            if page is not None:
+                return page
+    return None
+
+
+def _prune_cache():
+    """Remove cache files older than _CACHE_DAYS. Only run after fetching,
+    which happens about once a day"""
+    for file_date, _, file in _cache_files():
+        if (_CURRENT_DATE - file_date).days > _CACHE_DAYS:
+            _dprint("Removing old cache file " + file)
+            try:
+                os.remove(_CONFIG_DIR + file)
+            except OSError as e:
+                _eprint("Failed to remove {}: {}".format(file, e))
+
+
+def _write_atomic(file_path, content):
+    """Write a file through a temporary file renamed over it, so readers
+    see either the old or the new content in full"""
+    temp_path = "{}.{}.tmp".format(file_path, os.getpid())
+    try:
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, file_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _write_cache(page, source):
+    """Write parsed page of a source to cache"""
     global _CONFIG_DIR, _CURRENT_DATE, _FILE_PREFIX
     _check_config_dir()
-    file_path = _CONFIG_DIR + _FILE_PREFIX + str(_CURRENT_DATE)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    obj_encoded = jsonpickle.encode(obj)
-    with open(file_path, "w+") as f:
-        f.write(obj_encoded)
+    _write_atomic(_cache_path(_CURRENT_DATE, source), _encode_page(page))
+
+
+def _tokenize(text):
+    """Lower case words of a text"""
+    return re.findall(r"\w+", text.lower())
+
+
+def _read_history():
+    """Read meal history as a list of [date, source, restaurant, meal] and
+    an inverted index from each word to the positions of the meals having
+    it, with the words sorted. None if there is no history yet"""
+    try:
+        with open(_CONFIG_DIR + _HISTORY_FILE, encoding="utf-8") as f:
+            version, meals, index = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, TypeError) as e:
+        _eprint("Failed to read {}: {}".format(_HISTORY_FILE, e))
+        return None
+    if version != _CACHE_VERSION:
+        return None
+    return meals, index
+
+
+def _update_history(page, source):
+    """Replace today's meals of a source in the history, drop days older than
+    _HISTORY_DAYS and rebuild the index. A missing history is seeded from
+    the cached pages"""
+    history = _read_history()
+    if history is not None:
+        meals = history[0]
+    else:
+        meals = []
+        for file_date, file_source, file in _cache_files():
+            if file_source is not None and file_date < _CURRENT_DATE:
+                cached = _read_page(_CONFIG_DIR + file)
+                if cached is not None:
+                    meals.extend([str(file_date), file_source, r.name, m.name]
+                                 for r in cached.restaurants() for m in r.meals)
+
+    today = str(_CURRENT_DATE)
+    oldest = str(_CURRENT_DATE - datetime.timedelta(days=_HISTORY_DAYS))
+    meals = [m for m in meals if m[0] > oldest and not (m[0] == today and m[1] == source)]
+    meals.extend([today, source, r.name, m.name]
+                 for r in page.restaurants() for m in r.meals)
+    meals.sort(key=lambda m: m[0], reverse=True)
+
+    index = dict()
+    for position, meal in enumerate(meals):
+        for token in set(_tokenize(meal[3])):
+            index.setdefault(token, []).append(position)
+    index = {token: index[token] for token in sorted(index)}
+
+    _check_config_dir()
+    _write_atomic(_CONFIG_DIR + _HISTORY_FILE,
+                  json.dumps([_CACHE_VERSION, meals, index], ensure_ascii=False, separators=(",", ":")))
+
+
+def _search_history(query):
+    """Meals of the history with every word of the query as a prefix of one
+    of their words, as [date, source, restaurant, meal] newest first"""
+    history = _read_history()
+    tokens = _tokenize(query)
+    if history is None or len(tokens) == 0:
+        return []
+    meals, index = history
+    words = list(index)
+    positions = None
+    for token in tokens:
+        # Words with the token as a prefix are next to each other
+        matching = set()
+        for word in words[bisect.bisect_left(words, token):]:
+            if not word.startswith(token):
+                break
+            matching.update(index[word])
+        positions = matching if positions is None else positions & matching
+        if len(positions) == 0:
+            return []
+    return [meals[p] for p in sorted(positions)]
+
+
+def _load_sources():
+    """Built-in sources updated with the ones configured in _SOURCES_FILE, a
+    JSON list of objects with the name, url, parser, timeout and
+    restaurants of a source"""
+    sources = dict(SOURCES)
+    try:
+        with open(_CONFIG_DIR + _SOURCES_FILE, encoding="utf-8") as f:
+            configured = json.load(f)
+    except FileNotFoundError:
+        return sources
+    except (OSError, ValueError) as e:
+        _eprint("Failed to read {}: {}".format(_SOURCES_FILE, e))
+        return sources
+    for config in configured:
+        try:
+            source = Source(config["name"], config["url"], config.get("parser", "murkinat"),
+                            float(config.get("timeout", 10)), dict(config.get("restaurants", {})))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            _eprint("Invalid source in {}: {}".format(_SOURCES_FILE, config))
+            continue
+        if source.parser not in PARSERS:
+            _eprint("Unknown parser {} for source {}".format(source.parser, source.name))
+            continue
+        sources[source.name] = source
+    return sources
 
 
 def _dprint(str):
@@ -120,11 +369,37 @@ def _prettify_string(str):
     return str.replace("\xa0", " ").strip()
 
 
-def _get_argument(flag, alternative):
-    """"Fetch value for command line argument"""
-    for ind, arg in enumerate(sys.argv):
-        if arg == flag or arg == alternative and alternative is not None:
-            return sys.argv[ind + 1]
+def _parse_arguments(sources, restaurants):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(
+        prog="getfudd",
+        description="StudentRestaurantScraper\n\n"
+                    "Search for daily meal lists from Turku's student restaurants",
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-r", "--restaurant", choices=restaurants.keys(), metavar="ID",
+                        help="Show only specific restaurant")
+    parser.add_argument("-l", "--list", action="store_true",
+                        help="List all restaurant IDs")
+    parser.add_argument("-s", "--search",
+                        help="Search for a meal with specific word in it")
+    parser.add_argument("-H", "--history", metavar="WORDS",
+                        help="Find when and where meals with these words were served")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true",
+                        help="Print the restaurants as a JSON array")
+    output.add_argument("--ndjson", action="store_true",
+                        help="Print each restaurant as a line of JSON")
+    parser.add_argument("--prefetch", action="store_true",
+                        help="Refresh the cache of every source and exit")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Keep refreshing the cache on a schedule")
+    parser.add_argument("-c", "--clear-cache", action="store_true",
+                        help="Refresh cached content, only downloading what changed")
+    parser.add_argument("-S", "--source", action="append", choices=sources.keys(),
+                        help="Only scrape this source, can be given several times")
+    parser.add_argument("-u", "--url",
+                        help="Override the scraped URL of a single source")
+    return parser.parse_args()
 
 
 def _parse_meals(soup):
@@ -144,6 +419,91 @@ def _parse_meals(soup):
     return meals
 
 
+def _split_restaurants(content):
+    """Split page into the raw HTML blocks of its restaurants, None if the
+    restaurant list is not found"""
+    start = _RESTAURANTS_START.search(content)
+    if start is None:
+        return None
+    starts = [m.start() for m in _RESTAURANT_START.finditer(content, start.end())]
+    return [content[a:b] for a, b in zip(starts, starts[1:] + [len(content)])]
+
+
+def _parse_page(content, cached=None):
+    """Parse restaurants from page content, yielding (block hash, restaurant)
+    as each one is parsed. Blocks whose hash matches a block of the cached
+    page are not parsed again"""
+    blocks = _split_restaurants(content)
+    # Only needed when something changed, so not imported on the cached path
+    import hashlib
+    from bs4 import BeautifulSoup
+    if blocks is None:
+        _dprint("Restaurant blocks not found, parsing whole page")
+        soup = BeautifulSoup(content, "html.parser")
+        for r in soup.select("div.restaurants > div.restaurant"):
+            yield None, _parse_restaurant(r)
+        return
+
+    known = dict(cached.blocks) if cached is not None else {}
+    for block in blocks:
+        block_hash = hashlib.sha1(block).hexdigest()
+        if block_hash in known:
+            rest = known[block_hash]
+        else:
+            _dprint("Parsing changed block " + block_hash)
+            soup = BeautifulSoup(block, "html.parser").select_one("div.restaurant")
+            rest = _parse_restaurant(soup) if soup is not None else None
+        yield block_hash, rest
+
+
+def _fetch_page(http, source, cached=None):
+    """Fetch the page of a source, sending the cached page's validators so
+    an unchanged page is not downloaded. Returns the response, which has
+    status 304 if the cached page is still valid, or None on an unexpected
+    HTTP status"""
+    import urllib3
+    headers = {}
+    if cached is not None:
+        if cached.etag is not None:
+            headers["If-None-Match"] = cached.etag
+        if cached.last_modified is not None:
+            headers["If-Modified-Since"] = cached.last_modified
+    _dprint("Sending request to " + source.url)
+    http_response = http.request("GET", source.url, headers=headers,
+                                 timeout=urllib3.Timeout(total=source.timeout),
+                                 retries=urllib3.Retry(connect=1, read=0, redirect=3))
+    _dprint("Received response from " + source.url)
+    if http_response.status == 304:
+        _dprint("Page of {} not modified".format(source.name))
+    elif http_response.status != 200:
+        _eprint("Received a non-OK HTTP status code from {}: {}".format(
+            source.name, http_response.status))
+        return None
+    return http_response
+
+
+def _fetch_sources(fetches):
+    """Fetch the pages of (source, cached page) pairs concurrently over a
+    shared connection pool, yielding (source, cached page, response) as each
+    one finishes so a slow site does not hold back the others. The response
+    is None if the fetch failed"""
+    # Only needed when fetching, so not imported on the cached path
+    import urllib3
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    http = urllib3.PoolManager(num_pools=len(fetches), maxsize=2)
+    with ThreadPoolExecutor(max_workers=len(fetches)) as pool:
+        futures = {pool.submit(_fetch_page, http, source, cached): (source, cached)
+                   for source, cached in fetches}
+        for future in as_completed(futures):
+            source, cached = futures[future]
+            try:
+                response = future.result()
+            except urllib3.exceptions.HTTPError as e:
+                _eprint("Failed to fetch {}: {}".format(source.name, e))
+                response = None
+            yield source, cached, response
+
+
 def _parse_restaurant(soup):
     """Parse HTML representing a restaurant"""
     try:
@@ -160,104 +520,203 @@ def _parse_restaurant(soup):
     return rest
 
 
-if __name__ == "__main__":
-    _dprint("Entering application")
-
-    # Handle arguments
-    argument_url = _get_argument("-u", "--url")
-    URL = argument_url if argument_url is not None else URL
-    argument_restaurant = _get_argument("-r", "--restaurant")
-    if argument_restaurant is not None:
-        if argument_restaurant not in RESTAURANTS.keys():
-            _eprint("No such restaurant ID")
-            exit()
-        _RESTAURANT = RESTAURANTS[argument_restaurant]
-    argument_clear_cache = _get_argument("-c", "--clear-cache")
-    argument_search = _get_argument("-s", "--search")
-    _SEARCH = argument_search if argument_search is not None else None
-
-    _dprint("Handled arguments")
-
-    # Remove old files and read from cache if available
-    if not argument_clear_cache:
-        _dprint("Reading cache")
-        _read_cache()
-
-    # List restaurants
-    if "-l" in sys.argv or "--list" in sys.argv:
-        print("ID - Restaurant name")
-        print("--------------------")
-        for k, v in RESTAURANTS.items():
-            print("{} - {}".format(k, v))
-        exit()
-
-    # Show help
-    if "-h" in sys.argv or "--help" in sys.argv:
-        print("""StudentRestaurantScraper
-
-Search for daily meal lists from Turku's student restaurants
-
-Arguments:
--h --help           Display this help
--r --restaurant     Show only specific restaurant
--l --list           List all restaurant IDs
--s --search         Search for a meal with specific word in it
--c --clear-cache    Deletes cache and retrieves new content explicitly
--u --url            Override the scraped URL""")
-        exit()
-
-    if _CACHED_RESTAURANTS is None:
-        http = urllib3.PoolManager(num_pools=1)
-        _dprint("Sending request to " + URL)        
-        http_response = http.request("GET", URL)
-        http_response_status = http_response.status
-        _dprint("Received response")        
-        if http_response_status != 200:
-            _eprint(
-                "Received a non-OK HTTP status code: {}".format(http_response_status))
-            exit()
-
-        content = http_response.data
-        _dprint("Creating soup")        
-        soup = BeautifulSoup(content, "html.parser")
-
-        _dprint("Parsing content")    
+# Page parsers of sources by ID. A parser is a generator taking the page
+# content and the page cached from the previous fetch, or None, and yielding
+# (hash, Restaurant) for every restaurant block in page order
+PARSERS = {
+    "murkinat": _parse_page,
+}
 
-        # Find all .restaurant elements
-        soup_restaurants = soup.select("div.restaurants > div.restaurant")
-        restaurant_objs = [_parse_restaurant(r) for r in soup_restaurants]
-        restaurant_objs = [r for r in restaurant_objs if r is not None]
 
-        # Cache file
-        _dprint("Caching restaurant information")
-        _write_cache(restaurant_objs)
+def iter_restaurants(sources=None, restaurant=None, refresh=False):
+    """Yield (source ID, Restaurant) for today's menus, each restaurant as
+    soon as it is parsed. Sources cached today come first and the rest as
+    their pages arrive. sources is a list of source IDs or Source objects,
+    every configured source by default. restaurant limits the menus to a
+    restaurant ID and refresh revalidates today's cache. Raises ValueError
+    on an unknown source or restaurant ID"""
+    global _CURRENT_DATE
+    # Long running callers may cross midnight
+    _CURRENT_DATE = datetime.date.today()
+
+    configured = _load_sources()
+    if sources is None:
+        selected = list(configured.values())
     else:
-        restaurant_objs = _CACHED_RESTAURANTS
-        _dprint("Restraurant information loaded from cache")
-
-    # Filter restaurant
-    if (_RESTAURANT is not None):
-        _dprint("Filtering by restaurant")        
-        restaurant_objs = [r for r in restaurant_objs if r.name.lower(
-        ).strip() == _RESTAURANT.lower().strip()]
-        if len(restaurant_objs) is None:
-            _eprint("No restaurants found")
-            exit()
+        selected = []
+        for source in sources:
+            if not isinstance(source, Source):
+                if source not in configured:
+                    raise ValueError("No such source ID: {}".format(source))
+                source = configured[source]
+            selected.append(source)
+    rest_name = None
+    if restaurant is not None:
+        # Only the sources listing the restaurant need to be scraped
+        selected = [s for s in selected if restaurant in s.restaurants]
+        if len(selected) == 0:
+            raise ValueError("No such restaurant ID: {}".format(restaurant))
+        rest_name = selected[0].restaurants[restaurant].lower().strip()
+
+    def wanted(rest):
+        return rest is not None and (rest_name is None or rest.name.lower().strip() == rest_name)
+
+    return _iter_sources(selected, wanted, refresh)
+
+
+def _iter_sources(selected, wanted, refresh=False, failed=None):
+    """Yield (source ID, Restaurant) for the restaurants of the selected
+    sources accepted by wanted, see iter_restaurants. The IDs of sources
+    that could not be fetched are appended to failed"""
+    # Cached sources first, the cache is read when refreshing too to only
+    # download and parse what changed
+    fetches = []
+    for source in selected:
+        _dprint("Reading cache of " + source.name)
+        page = _read_cache(source.name)
+        if page is not None and not refresh:
+            _dprint("Restaurant information of {} loaded from cache".format(source.name))
+            for rest in page.restaurants():
+                if wanted(rest):
+                    yield source.name, rest
+            continue
+        if page is None:
+            page = _read_latest_cache(source.name)
+        fetches.append((source, page))
+    if len(fetches) == 0:
+        return
+
+    # Source, page and its blocks left to parse while a fetched page is read
+    current = None
+    try:
+        for source, cached, response in _fetch_sources(fetches):
+            if response is None:
+                if failed is not None:
+                    failed.append(source.name)
+                if cached is not None:
+                    _eprint("Showing the cached menu of {}".format(source.name))
+                    for rest in cached.restaurants():
+                        if wanted(rest):
+                            yield source.name, rest
+                continue
+
+            if response.status == 304:
+                page = cached
+                current = (source, page, ())
+                for rest in page.restaurants():
+                    if wanted(rest):
+                        yield source.name, rest
+            else:
+                _dprint("Parsing content of " + source.name)
+                page = _Page(response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                blocks = PARSERS[source.parser](response.data, cached)
+                current = (source, page, blocks)
+                for block in blocks:
+                    page.blocks.append(block)
+                    if wanted(block[1]):
+                        yield source.name, block[1]
+            current = None
+            _cache_page(page, source.name)
+    except GeneratorExit:
+        # The caller stopped early, the page being read is cached all the same
+        # so the next call does not download and parse it again
+        if current is not None:
+            source, page, blocks = current
+            page.blocks.extend(blocks)
+            _cache_page(page, source.name)
+        raise
+    finally:
+        _prune_cache()
+
+
+def _cache_page(page, source_id):
+    """Write a complete page to today's cache and the meal history"""
+    _dprint("Caching restaurant information of " + source_id)
+    _write_cache(page, source_id)
+    _update_history(page, source_id)
+
+
+def _prefetch(selected):
+    """Refresh the cache of the selected sources, returns the IDs of the
+    sources that failed"""
+    failed = []
+    for _ in _iter_sources(selected, lambda rest: False, True, failed):
+        pass
+    return failed
+
+
+def _next_prefetch(now):
+    """Time of the next scheduled prefetch after now"""
+    start = datetime.datetime.combine(now.date(), _PREFETCH_START)
+    end = datetime.datetime.combine(now.date(), _PREFETCH_END)
+    tomorrow = start + datetime.timedelta(days=1)
+    if now < start:
+        return start
+    runs = int((now - start).total_seconds() // _PREFETCH_INTERVAL) + 1
+    next_run = start + datetime.timedelta(seconds=runs * _PREFETCH_INTERVAL)
+    return next_run if next_run <= end else tomorrow
+
+
+def _run_daemon(selected):
+    """Prefetch the selected sources on schedule until interrupted, starting
+    right away so the cache is warm from the start"""
+    global _CURRENT_DATE
+    backoff = None
+    while True:
+        _CURRENT_DATE = datetime.date.today()
+        try:
+            failed = _prefetch(selected)
+        except Exception as e:
+            # A full disk or a broken cache file must not stop the schedule
+            _eprint("Refresh failed: {}".format(e))
+            failed = [s.name for s in selected]
+        now = datetime.datetime.now()
+        if len(failed) > 0:
+            backoff = _PREFETCH_BACKOFF if backoff is None else min(backoff * 2, _PREFETCH_INTERVAL)
+            wake = now + datetime.timedelta(seconds=backoff)
+            print("{} Failed to refresh {}, retrying at {}".format(
+                now.strftime("%Y-%m-%d %H:%M:%S"), ", ".join(failed), wake.strftime("%H:%M:%S")))
+        else:
+            backoff = None
+            wake = _next_prefetch(now) + datetime.timedelta(
+                seconds=random.uniform(0, _PREFETCH_JITTER))
+            print("{} Refreshed, next refresh at {}".format(
+                now.strftime("%Y-%m-%d %H:%M:%S"), wake.strftime("%Y-%m-%d %H:%M:%S")))
+        sys.stdout.flush()
+        # Sleep in steps so a suspended machine catches up when it wakes
+        while datetime.datetime.now() < wake:
+            time.sleep(min(60, max(0, (wake - datetime.datetime.now()).total_seconds())))
+
+
+def get_restaurants(sources=None, restaurant=None, refresh=False):
+    """List of (source ID, Restaurant) for today's menus, see
+    iter_restaurants"""
+    return list(iter_restaurants(sources, restaurant, refresh))
+
+
+def _restaurant_record(source, rest, search=None):
+    """Restaurant as a JSON serializable record, meals matching the search
+    pattern are marked when one is given"""
+    meals = []
+    for meal in rest.meals:
+        record = {"name": meal.name, "price": meal.price}
+        if search is not None:
+            record["match"] = search.search(meal.name) is not None
+        meals.append(record)
+    return {"source": source, "restaurant": rest.name, "meals": meals}
+
 
+def _print_restaurants(restaurant_objs):
+    """Filter restaurants by _SEARCH and print them"""
     filtered_meals = None
     # Filter by search word in meals
     if _SEARCH is not None:
-        _dprint("Filtering by word")            
-        _SEARCH = _SEARCH.lower()
-        filtered_restaurants = []
-        filtered_meals = []
-        for rest in restaurant_objs:
-            for meal in rest.meals:
-                match = re.search(_SEARCH, meal.name, re.I)
-                if match is not None:
-                    filtered_restaurants.append(rest)
-                    filtered_meals.append(meal)
-        restaurant_objs = filtered_restaurants
+        _dprint("Filtering by word")
+        search = re.compile(_SEARCH, re.I)
+        filtered_meals = {meal for rest in restaurant_objs for meal in rest.meals
+                          if search.search(meal.name) is not None}
+        restaurant_objs = [r for r in restaurant_objs
+                           if any(meal in filtered_meals for meal in r.meals)]
 
     # Output all scraped and filtered data in somewhat pretty format
     for rest in restaurant_objs:
@@ -271,5 +730,94 @@ Arguments:
             else:
                 print(meal_str)
         print("\n")
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    _dprint("Entering application")
+
+    # Handle arguments
+    sources = _load_sources()
+    restaurants = dict()
+    for source in sources.values():
+        restaurants.update(source.restaurants)
+    arguments = _parse_arguments(sources, restaurants)
+    selected = list(dict.fromkeys(arguments.source)) if arguments.source else None
+    if arguments.restaurant is not None:
+        _RESTAURANT = restaurants[arguments.restaurant]
+    if arguments.url is not None:
+        if selected is None and len(sources) == 1:
+            selected = list(sources)
+        if selected is None or len(selected) != 1:
+            _eprint("Choose a single source with --source to override its URL")
+            exit()
+        source = sources[selected[0]]
+        selected = [Source(source.name, arguments.url, source.parser, source.timeout,
+                           source.restaurants)]
+    _SEARCH = arguments.search
+
+    _dprint("Handled arguments")
+
+    # List restaurants
+    if arguments.list:
+        print("ID - Restaurant name")
+        print("--------------------")
+        for k, v in restaurants.items():
+            print("{} - {}".format(k, v))
+        exit()
+
+    # Search the history of fetched menus
+    if arguments.history is not None:
+        served = _search_history(arguments.history)
+        if _RESTAURANT is not None:
+            served = [m for m in served if m[2].lower().strip() == _RESTAURANT.lower().strip()]
+        if len(served) == 0:
+            _eprint("Not served in the last {} days".format(_HISTORY_DAYS))
+            exit()
+        for date, source, rest_name, meal_name in served:
+            print("{} {}: `{}`".format(date, rest_name, meal_name))
+        exit()
+
+    # Refresh the cache in the background of interactive runs
+    if arguments.prefetch or arguments.daemon:
+        prefetched = list(sources.values()) if selected is None else [
+            s if isinstance(s, Source) else sources[s] for s in selected]
+        if arguments.daemon:
+            try:
+                _run_daemon(prefetched)
+            except KeyboardInterrupt:
+                pass
+            exit()
+        failed = _prefetch(prefetched)
+        exit(1 if len(failed) > 0 else 0)
+
+    try:
+        menus = iter_restaurants(selected, arguments.restaurant, arguments.clear_cache)
+        # Print each restaurant as soon as it is parsed
+        if arguments.json or arguments.ndjson:
+            search = re.compile(_SEARCH, re.I) if _SEARCH is not None else None
+            separator = "[" if arguments.json else ""
+            for source, rest in menus:
+                record = _restaurant_record(source, rest, search)
+                if search is not None and not any(m["match"] for m in record["meals"]):
+                    continue
+                print(separator + json.dumps(record, ensure_ascii=False), flush=True)
+                if arguments.json:
+                    separator = ","
+            if arguments.json:
+                print("[]" if separator == "[" else "]")
+        else:
+            for source, rest in menus:
+                _print_restaurants([rest])
+    except ValueError as e:
+        _eprint(e)
+        exit()
+    except BrokenPipeError:
+        # Piped into a command that stopped reading, like head. Closing the
+        # menus still caches the page being read
+        menus.close()
+        # Python flushes stdout on exit, point it where that cannot fail
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        exit(1)
 
     _dprint("Exiting application successfully")
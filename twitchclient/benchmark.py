@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# Compare twitchclient's batched polling against the original per-channel
+# polling on a multiprocessing pool, using a local mock of the streams API
+
+import argparse
+import http.server
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from multiprocessing import Pool
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+import twitchclient  # noqa: E402
+
+# Delay of every mock response in seconds
+LATENCY = 0.03
+# Requests the mock allows per RATE_WINDOW seconds
+RATE_LIMIT = 800
+RATE_WINDOW = 60
+
+_legacy_address = None
+
+
+def _stream(name):
+    return {
+        "channel": {"name": name, "status": "Playing with {}".format(name)},
+        "created_at": "2015-10-28T16:13:41Z",
+        "stream_type": "live",
+        "game": "Game",
+    }
+
+
+def _is_live(name):
+    return int(name.rsplit("_", 1)[1]) % 3 == 0
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    lock = threading.Lock()
+    requests = []
+
+    def do_GET(self):
+        time.sleep(LATENCY)
+        url = urllib.parse.urlsplit(self.path)
+        now = time.time()
+        with _Handler.lock:
+            _Handler.requests = [t for t in _Handler.requests if t > now - RATE_WINDOW]
+            _Handler.requests.append(now)
+            remaining = max(0, RATE_LIMIT - len(_Handler.requests))
+        if url.path.rstrip("/").endswith("/streams"):
+            names = urllib.parse.parse_qs(url.query)["channel"][0].split(",")
+            body = {"streams": [_stream(n) for n in names if _is_live(n)]}
+        else:
+            name = url.path.rsplit("/", 1)[1]
+            body = {"stream": _stream(name) if _is_live(name) else None}
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Ratelimit-Limit", str(RATE_LIMIT))
+        self.send_header("Ratelimit-Remaining", str(remaining))
+        self.send_header("Ratelimit-Reset", str(int(now + RATE_WINDOW)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+# Original implementation, one request and one connection per channel
+def _legacy_get_stream_status(name):
+    response = requests.get(_legacy_address.format(name), headers={"Client-ID": "x"})
+    if response.ok is not True:
+        return None
+    return json.loads(response.text)
+
+
+def _legacy_get_stream_objects(channel_names):
+    pool = Pool()
+    responses = pool.map(_legacy_get_stream_status, channel_names)
+    return responses
+
+
+# Start every measurement with an empty rate limit window, so that neither
+# poller is throttled by requests the other one made
+def _reset_rate_limit():
+    with _Handler.lock:
+        _Handler.requests = []
+
+
+def main():
+    global _legacy_address
+    parser = argparse.ArgumentParser(prog="twitchclient polling benchmark")
+    parser.add_argument("-n", "--channels", default="50,300,1000",
+                        help="comma separated channel counts")
+    args = parser.parse_args()
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = "http://127.0.0.1:{}/kraken/streams/".format(server.server_port)
+    _legacy_address = base + "{}"
+
+    print("{:>9} {:>10} {:>10} {:>8} {:>9} {:>12}".format(
+        "channels", "legacy ms", "batched ms", "speedup", "requests", "slowest ms"))
+    for count in [int(n) for n in args.channels.split(",")]:
+        names = ["channel_{}".format(i) for i in range(count)]
+
+        _reset_rate_limit()
+        started = time.perf_counter()
+        legacy = _legacy_get_stream_objects(names)
+        legacy_time = time.perf_counter() - started
+
+        _reset_rate_limit()
+        started = time.perf_counter()
+        streams, latencies, failed = twitchclient._get_stream_objects("x", names, base)
+        batched_time = time.perf_counter() - started
+
+        legacy_live = sorted(r["stream"]["channel"]["name"] for r in legacy if r["stream"] is not None)
+        if len(failed) > 0 or legacy_live != sorted(s["channel"]["name"] for s in streams):
+            print("Live channels differ from the original implementation", file=sys.stderr)
+            exit(1)
+        print("{:>9} {:>10.0f} {:>10.0f} {:>7.1f}x {:>9} {:>12.0f}".format(
+            count, legacy_time * 1000, batched_time * 1000, legacy_time / batched_time,
+            len(latencies), max(latencies) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,8 @@
 # Use of `streamlink` from pip is recommended
 
 from __future__ import print_function
-import requests, json, sys, subprocess, os
-from multiprocessing import Pool
+import requests, json, sys, subprocess, os, threading, time, shlex, socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from datetime import datetime
 from cursesmenu import *
@@ -25,8 +25,6 @@ class bcolors:
     BOLD = '\033[1m'
     UNDERLINE = '\033[4m'
 
-print(bcolors.OKGREEN + "Welcome to {}".format(APP_NAME) + bcolors.ENDC)
-
 # Print to stderr
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
@@ -35,117 +33,532 @@ def eprint(*args, **kwargs):
 CONFIG_LOCATIONS = [
     "{}/.config/twitchnotifier/config.json".format(str(Path.home()))
 ]
-
-_config = None
-
-# Read configuration
-for config_location in CONFIG_LOCATIONS:
-    try:
-        with open(config_location) as f:
-            _config = json.load(f)
-    except Exception as e:
-        continue
-    if _config is not None: break
-
-if _config is None:
-   eprint("Failed to load config file")
-   exit()
-
-CLIENT_ID = _config["ApiKey"]
-STREAMS = _config["Channels"]
-STREAMS = [s.lower() for s in STREAMS]
-#COMMAND_NOTIFY = _config["NotifyCommand"]
-COMMAND_STREAM = _config["StreamCommand"]
-if (CLIENT_ID is None):
-    eprint("Api key is missing")
-    exit()
-API_BASE_ADDRESS = "https://api.twitch.tv/kraken/streams/{}"
+# Online streams seen by the latest watch poll
+STATE_LOCATION = "{}/.config/twitchnotifier/state.json".format(str(Path.home()))
+# Results of the latest poll, shown while a new one runs
+CACHE_LOCATION = "{}/.config/twitchnotifier/cache.json".format(str(Path.home()))
+# Seconds the cached results are used without polling again, CacheTTL in config
+CACHE_TTL = 60
+
+# Streams endpoint, takes a comma separated list of up to BATCH_SIZE channels
+API_BASE_ADDRESS = "https://api.twitch.tv/kraken/streams/"
 STREAM_BASE_ADDRESS = "https://www.twitch.tv/{}"
 QUALITIES = ["best", "160p", "360p", "480p", "720p"]
+# mpv's format selection for every quality, used when switching streams over IPC
+PLAYER_FORMATS = {"best": "best"}
+PLAYER_FORMATS.update({q: "best[height<={}]".format(q[:-1]) for q in QUALITIES if q != "best"})
+# Seconds to wait for a running player to answer
+PLAYER_TIMEOUT = 1
+
+# Polling: channels per request, requests in flight and tries per request
+BATCH_SIZE = 100
+POLL_CONCURRENCY = 4
+POLL_RETRIES = 3
+POLL_TIMEOUT = 10
+
+# Watch mode: seconds between polls, growing while nothing changes and after
+# failures, and polls a stream must be missing before it counts as offline
+WATCH_INTERVAL = 30
+WATCH_MAX_INTERVAL = 120
+WATCH_FAILED_MAX_INTERVAL = 300
+WATCH_OFFLINE_POLLS = 2
+
+
+# Read configuration from the first location that has it
+def _load_config():
+    for config_location in CONFIG_LOCATIONS:
+        try:
+            with open(config_location) as f:
+                return json.load(f)
+        except Exception as e:
+            continue
+    return None
 
 
-if (len(STREAMS) == 0):
-    eprint("No streams listed")
-    exit()
-
+# Version 3 of the API takes channel names, version 5 would need their IDs
 def _get_headers(client_id):
     return {
-        "Client-ID": client_id
+        "Client-ID": client_id,
+        "Accept": "application/vnd.twitchtv.v3+json"
+    }
+
+
+# Rate limit shared by the polling threads, from the Ratelimit-* headers of
+# the latest response
+class _RateLimit:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset = 0
+
+    # Block until a request may be sent
+    def wait(self):
+        with self.lock:
+            delay = self.reset - time.time() if self.remaining == 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, response):
+        remaining = response.headers.get("Ratelimit-Remaining")
+        reset = response.headers.get("Ratelimit-Reset")
+        with self.lock:
+            if remaining is not None:
+                self.remaining = int(remaining)
+            if reset is not None:
+                self.reset = float(reset)
+            elif response.status_code == 429:
+                self.remaining = 0
+                self.reset = time.time() + float(response.headers.get("Retry-After", 1))
+
+
+# Returns a session that keeps a connection open for every concurrent request
+def _get_session(client_id):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=POLL_CONCURRENCY)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(_get_headers(client_id))
+    return session
+
+
+# Poll a batch of channels, returns the live streams among them or None on failure
+def _get_stream_batch(session, channel_names, rate_limit, base_address=API_BASE_ADDRESS):
+    params = {"channel": ",".join(channel_names), "limit": len(channel_names)}
+    for attempt in range(POLL_RETRIES):
+        rate_limit.wait()
+        try:
+            response = session.get(base_address, params=params, timeout=POLL_TIMEOUT)
+        except requests.RequestException as e:
+            eprint("Polling failed: {}".format(e))
+            continue
+        rate_limit.update(response)
+        if response.status_code == 429:
+            continue
+        if response.ok is not True:
+            eprint("Polling failed with HTTP status {}".format(response.status_code))
+            return None
+        try:
+            return response.json()["streams"]
+        except (ValueError, KeyError):
+            eprint("Polling returned an invalid response")
+            return None
+    return None
+
+
+# Poll the status of channels in batches over a shared session. Yields every batch
+# as soon as it completes, with its live streams or None on failure and the latency
+# of the request in seconds. Long running callers pass their own session and rate
+# limit to reuse
+def _iter_stream_batches(client_id, channel_names, base_address=API_BASE_ADDRESS,
+                         session=None, rate_limit=None):
+    batches = [channel_names[i:i + BATCH_SIZE] for i in range(0, len(channel_names), BATCH_SIZE)]
+    if rate_limit is None:
+        rate_limit = _RateLimit()
+    own_session = session is None
+    if own_session:
+        session = _get_session(client_id)
+
+    def poll(batch):
+        started = time.perf_counter()
+        streams = _get_stream_batch(session, batch, rate_limit, base_address)
+        return streams, time.perf_counter() - started
+
+    try:
+        with ThreadPoolExecutor(max_workers=POLL_CONCURRENCY) as pool:
+            futures = {pool.submit(poll, batch): batch for batch in batches}
+            for future in as_completed(futures):
+                streams, latency = future.result()
+                yield futures[future], streams, latency
+    finally:
+        if own_session:
+            session.close()
+
+
+# Poll the status of channels, returns the live streams, the latency of every
+# request in seconds and the channels that could not be polled
+def _get_stream_objects(client_id, channel_names, base_address=API_BASE_ADDRESS,
+                        session=None, rate_limit=None):
+    streams = []
+    latencies = []
+    failed = []
+    for batch, batch_streams, latency in _iter_stream_batches(
+            client_id, channel_names, base_address, session, rate_limit):
+        latencies.append(latency)
+        if batch_streams is None:
+            failed.extend(batch)
+        else:
+            streams.extend(batch_streams)
+    return streams, latencies, failed
+
+
+# Pick the fields shown of a stream, None if it is not live
+def _parse_stream(info):
+    if info["stream_type"] != "live":
+        return None
+    return {
+        "name": info["channel"]["name"].lower(),
+        "started": info["created_at"],
+        "stream_type": info["stream_type"],
+        "game": info["game"],
+        "title": info["channel"]["status"]
     }
 
 
-def _get_stream_status(name):
-    global API_BASE_ADDRESS, CLIENT_ID
-    headers = _get_headers(CLIENT_ID)
-    response = requests.get(API_BASE_ADDRESS.format(name), headers = headers)
-    if response.ok is not True:
+# Read a JSON file, None if there is none
+def _read_json(location):
+    try:
+        with open(location) as f:
+            return json.load(f)
+    except (OSError, ValueError):
         return None
-    return json.loads(response.text)
 
 
-def _get_stream_objects(channel_names):
-    pool = Pool()
-    responses = pool.map(_get_stream_status, channel_names)
-    return responses
+# Write a JSON file through a temporary file so it is never half written
+def _write_json(location, data):
+    temp_location = location + ".tmp"
+    os.makedirs(os.path.dirname(location), exist_ok=True)
+    with open(temp_location, "w") as f:
+        json.dump(data, f)
+    os.replace(temp_location, location)
+
+
+# Read the state saved by watch mode, None if there is none
+def _load_state():
+    return _read_json(STATE_LOCATION)
+
+
+def _save_state(state):
+    _write_json(STATE_LOCATION, state)
 
 
+# Read the cached online streams of the channels, None if they were not all polled
+def _load_cache(channel_names):
+    cache = _read_json(CACHE_LOCATION)
+    if cache is None or set(cache["channels"]) != set(channel_names):
+        return None
+    return cache
+
+
+def _save_cache(channel_names, online_objs):
+    _write_json(CACHE_LOCATION, {"time": time.time(), "channels": channel_names, "online": online_objs})
+
+
+# Split a configured command into arguments and substitute the values in them, so
+# the values never reach a shell
+def _build_command(command, values):
+    arguments = []
+    for argument in shlex.split(command):
+        for key, value in values.items():
+            argument = argument.replace(key, value)
+        arguments.append(argument)
+    return arguments
+
+
+# Run the notify command for a stream going online or offline, with $name, $status,
+# $game, $title and $url substituted
+def _notify(command, status, stream):
+    values = {
+        "$name": stream["name"],
+        "$status": status,
+        "$game": stream.get("game") or "",
+        "$title": stream.get("title") or "",
+        "$url": STREAM_BASE_ADDRESS.format(stream["name"])
+    }
+    try:
+        subprocess.Popen(_build_command(command, values), stdin=subprocess.DEVNULL)
+    except OSError as e:
+        eprint("Notify command failed: {}".format(e))
+
+
+# Poll the channels until interrupted and notify of streams going online and
+# offline. Online streams are saved after every poll so a restart only notifies
+# of what changed while it was down
+def _watch(client_id, channel_names, notify_command):
+    state = _load_state()
+    online = None
+    missing = {}
+    # Channels whose status was not known when the baseline was taken
+    unknown = set()
+    if state is not None:
+        # Forget channels removed from the config since the state was saved
+        online = {n: s for n, s in state["online"].items() if n in channel_names}
+        missing = {n: c for n, c in state.get("missing", {}).items() if n in online}
+        unknown = set(state.get("unknown", [])) & set(channel_names)
+    session = _get_session(client_id)
+    rate_limit = _RateLimit()
+    interval = WATCH_INTERVAL
+
+    while True:
+        started = time.perf_counter()
+        streams, latencies, failed = _get_stream_objects(
+            client_id, channel_names, session=session, rate_limit=rate_limit)
+        elapsed = time.perf_counter() - started
+        polled = {}
+        for info in streams:
+            stream = _parse_stream(info)
+            if stream is not None:
+                polled[stream["name"]] = stream
+        timestamp = datetime.now().strftime("%H:%M:%S")
+
+        changed = False
+        if online is None:
+            # First run, nothing to compare against. Channels that failed join
+            # the baseline once polled
+            online = polled
+            unknown = set(failed)
+            print("{} Watching {} streams, {} online".format(timestamp, len(channel_names), len(online)))
+        else:
+            for name, stream in polled.items():
+                missing.pop(name, None)
+                if name not in online and name not in unknown:
+                    print("{} {} is online: {} - {}".format(timestamp, name, stream["game"], stream["title"]))
+                    if notify_command is not None:
+                        _notify(notify_command, "online", stream)
+                    changed = True
+                online[name] = stream
+            # Channels that failed to poll keep their previous status
+            failed_names = set(failed)
+            unknown &= failed_names
+            for name in [n for n in online if n not in polled and n not in failed_names]:
+                missing[name] = missing.get(name, 0) + 1
+                if missing[name] < WATCH_OFFLINE_POLLS:
+                    continue
+                print("{} {} is offline".format(timestamp, name))
+                if notify_command is not None:
+                    _notify(notify_command, "offline", online[name])
+                del online[name]
+                del missing[name]
+                changed = True
+        _save_state({"online": online, "missing": missing, "unknown": sorted(unknown),
+                     "updated": time.time()})
+        # Keep the menu's cache fresh while watching
+        if len(failed) == 0:
+            _save_cache(channel_names, list(polled.values()))
+
+        if len(failed) > 0:
+            eprint("{} Failed to poll {} channels".format(timestamp, len(failed)))
+            interval = min(interval * 2, WATCH_FAILED_MAX_INTERVAL)
+        elif changed:
+            interval = WATCH_INTERVAL
+        else:
+            interval = min(interval * 1.5, WATCH_MAX_INTERVAL)
+        time.sleep(max(0, interval - elapsed))
+
+
+def _stream_text(stream):
+    return "{} - {} - {}".format(stream["name"], stream["game"], stream["title"])
+
+
+# Update the menu in place: change the text of streams still online, remove the
+# ones gone offline and append new ones. An error entry is shown below the offline
+# count. The highlight stays on the same item however the list shifts under it
+def _update_menu(menu, quality_submenu, stream_items, offline_item, online_objs, offline_count,
+                 error_item=None):
+    highlighted = None
+    if 0 <= menu.current_option < len(menu.items):
+        highlighted = menu.items[menu.current_option]
+    if error_item is not None and error_item not in menu.items:
+        # Appending resizes the screen for the new entry, then move it in place
+        menu.append_item(error_item)
+        menu.items.remove(error_item)
+        menu.items.insert(menu.items.index(offline_item) + 1, error_item)
+    online_names = set()
+    for stream in online_objs:
+        name = stream["name"]
+        online_names.add(name)
+        if name in stream_items:
+            stream_items[name].text = _stream_text(stream)
+            continue
+        # Open stream with streamlink
+        item = FunctionItem(_stream_text(stream), _open_stream,
+                            [STREAM_BASE_ADDRESS.format(name), quality_submenu])
+        stream_items[name] = item
+        menu.append_item(item)
+    for name in [n for n in stream_items if n not in online_names]:
+        menu.items.remove(stream_items.pop(name))
+    offline_item.text = "Offline streamers: {}".format(offline_count)
+    if highlighted in menu.items:
+        menu.current_option = menu.items.index(highlighted)
+    else:
+        # The highlighted stream went offline
+        menu.current_option = min(menu.current_option, len(menu.items) - 1)
+    if menu.is_running():
+        menu.draw()
+
+
+def _failed_text(failed):
+    names = ", ".join(failed[:5])
+    if len(failed) > 5:
+        names += " and {} more".format(len(failed) - 5)
+    return "Failed to poll {} channels: {}".format(len(failed), names)
+
+
+# Poll in the background and update the menu as every batch completes. Channels
+# that fail keep their cached status and are listed in an error entry. Complete
+# results are cached for the next launch
+def _refresh_menu(menu, quality_submenu, stream_items, offline_item, cache):
+    online = {s["name"]: s for s in cache["online"]} if cache is not None else {}
+    # Channels whose status is known, from the cache or from this poll
+    known = set(STREAMS) if cache is not None else set()
+    failed = []
+    error_item = None
+    started = time.perf_counter()
+    for batch, streams, latency in _iter_stream_batches(CLIENT_ID, STREAMS):
+        if streams is None:
+            failed.extend(batch)
+            if error_item is None:
+                error_item = MenuItem(_failed_text(failed))
+            else:
+                error_item.text = _failed_text(failed)
+        else:
+            known.update(batch)
+            for name in batch:
+                online.pop(name, None)
+            for info in streams:
+                stream = _parse_stream(info)
+                if stream is not None:
+                    online[stream["name"]] = stream
+        _update_menu(menu, quality_submenu, stream_items, offline_item, list(online.values()),
+                     len(known) - len(online), error_item)
+
+    menu.subtitle = "Select online streamer (polled in {:.0f} ms)".format(
+        (time.perf_counter() - started) * 1000)
+    if len(failed) == 0:
+        _save_cache(STREAMS, list(online.values()))
+    if menu.is_running():
+        menu.draw()
+
+
+# Players started from the menu that may still be running
+_players = []
+
+
+# Forget players that have exited, collecting their exit status
+def _reap_players():
+    _players[:] = [p for p in _players if p.poll() is None]
+
+
+# Send commands to an mpv IPC socket, returns True if the last one succeeded
+def _player_command(socket_location, commands):
+    with socket.socket(socket.AF_UNIX) as s:
+        s.settimeout(PLAYER_TIMEOUT)
+        s.connect(socket_location)
+        for request_id, command in enumerate(commands):
+            s.sendall((json.dumps({"command": command, "request_id": request_id}) + "\n").encode("utf-8"))
+        # Replies come in order among event lines, which have no request_id
+        for line in s.makefile("r", encoding="utf-8"):
+            reply = json.loads(line)
+            if reply.get("request_id") == len(commands) - 1:
+                return reply.get("error") == "success"
+    return False
+
+
+# Switch an already running player to the stream over its IPC socket. Returns False
+# if no player is listening, so a new one should be started
+def _switch_player(url, quality):
+    if PLAYER_SOCKET is None:
+        return False
+    try:
+        return _player_command(PLAYER_SOCKET, [
+            ["set_property", "ytdl-format", PLAYER_FORMATS[quality]],
+            ["loadfile", url]
+        ])
+    except (OSError, ValueError):
+        return False
+
+
+# Start a player for the stream without waiting for it, with $url, $quality and
+# $socket substituted in StreamCommand
+def _start_player(url, quality):
+    values = {"$url": url, "$quality": quality, "$socket": PLAYER_SOCKET or ""}
+    try:
+        # Own session so the player outlives the menu and ignores its Ctrl-C
+        _players.append(subprocess.Popen(_build_command(COMMAND_STREAM, values),
+                                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                         stderr=subprocess.DEVNULL, start_new_session=True))
+    except OSError as e:
+        eprint("Stream command failed: {}".format(e))
+
+
+# Open a stream in the running player if there is one, otherwise in a new one. The
+# menu stays open so several streams can be opened
 def _open_stream(url, quality_submenu):
     selection = quality_submenu.get_return()
     quality = QUALITIES[selection if selection is not None else 0]
-    full_command = COMMAND_STREAM.replace("$url", url).replace("$quality", quality)
-    os.system(full_command)
-    exit()
+    _reap_players()
+    if not _switch_player(url, quality):
+        _start_player(url, quality)
 
 
 if __name__ == "__main__":
-    online_streamers = []
-    online_objs = []
-    offline_streamers = []
-
-    print("Polling {} streams...".format(len(STREAMS)))
-
-    responses = _get_stream_objects(STREAMS)
-    for stream_status in responses:
-        info = stream_status["stream"]
-        if info is None:
-            continue # Not online
-        name = info["channel"]["name"]
-        title = info["channel"]["status"]
-        started = datetime.strptime(info["created_at"], "%Y-%m-%dT%H:%M:%SZ")
-        #"2015-10-28T16:13:41Z"
-        stream_type = info["stream_type"]
-        if stream_type != "live":
-            continue
-        game = info["game"]
-        online_streamers.append(name)
-        online_objs.append({
-            "name": name,
-            "started": started,
-            "stream_type": stream_type,
-            "game": game,
-            "title": title
-        })
-    offline_streamers = [n for n in STREAMS if n.lower() not in online_streamers]
-
-    print("Done. Online {}, offline {}".format(len(online_streamers), len(offline_streamers)))
+    print(bcolors.OKGREEN + "Welcome to {}".format(APP_NAME) + bcolors.ENDC)
+
+    _config = _load_config()
+    if _config is None:
+       eprint("Failed to load config file")
+       exit()
+
+    CLIENT_ID = _config["ApiKey"]
+    STREAMS = _config["Channels"]
+    STREAMS = [s.lower() for s in STREAMS]
+    COMMAND_NOTIFY = _config.get("NotifyCommand")
+    COMMAND_STREAM = _config["StreamCommand"]
+    # mpv IPC socket to reuse a running player, the player needs --input-ipc-server=$socket
+    PLAYER_SOCKET = _config.get("PlayerSocket")
+    if PLAYER_SOCKET is not None:
+        PLAYER_SOCKET = os.path.expanduser(PLAYER_SOCKET)
+    if (CLIENT_ID is None):
+        eprint("Api key is missing")
+        exit()
+
+    if (len(STREAMS) == 0):
+        eprint("No streams listed")
+        exit()
+
+    # Keep polling and notify of changes instead of showing the menu
+    if "-w" in sys.argv or "--watch" in sys.argv:
+        try:
+            _watch(CLIENT_ID, STREAMS, COMMAND_NOTIFY)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
+    CACHE_TTL = _config.get("CacheTTL", CACHE_TTL)
+
+    # Show the cached results right away and poll in the background if they are
+    # stale, or fill an empty menu as the polls complete
+    cache = _load_cache(STREAMS)
+    refresh = True
+    if cache is not None:
+        online_objs = cache["online"]
+        age = time.time() - cache["time"]
+        refresh = age >= CACHE_TTL
+        subtitle = "Select online streamer"
+        if refresh:
+            subtitle = "Select online streamer (refreshing results from {:.0f} s ago)".format(age)
+        online_streamers = [s["name"] for s in online_objs]
+        offline_streamers = [n for n in STREAMS if n not in online_streamers]
+    else:
+        online_objs = []
+        offline_streamers = []
+        subtitle = "Select online streamer (polling {} streams)".format(len(STREAMS))
 
     # Create Curses menu
-    menu = CursesMenu("Open stream", "Select online streamer")
+    menu = CursesMenu("Open stream", subtitle)
 
     quality_menu = SelectionMenu(QUALITIES)
     quality_submenu = SubmenuItem("Select stream quality", quality_menu, menu)
+    offline_item = MenuItem("Offline streamers: {}".format(len(offline_streamers)))
 
     menu.append_item(quality_submenu)
+    menu.append_item(offline_item)
 
-    i = 0
-    for online in online_streamers:
-        stream_url = STREAM_BASE_ADDRESS.format(online)
-        # Open stream with streamlink
-        item = FunctionItem(
-            "{} - {} - {}".format(online, online_objs[i]["game"], online_objs[i]["title"]), _open_stream, [stream_url, quality_submenu])
-        menu.append_item(item)
-        i += 1
+    stream_items = {}
+    _update_menu(menu, quality_submenu, stream_items, offline_item, online_objs, len(offline_streamers))
 
-    menu.append_item(MenuItem("Offline streamers: {}".format(len(offline_streamers))))
+    if refresh:
+        threading.Thread(target=_refresh_menu,
+                         args=[menu, quality_submenu, stream_items, offline_item, cache],
+                         daemon=True).start()
 
-    menu.show()
\ No newline at end of file
+    menu.show()